@@ -0,0 +1,384 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""
+    Filename : bench
+    Date: 17.10.2026 19:00
+    Project: pyRsyncBackup
+    AUTHOR : Sergey Utkin
+
+    Copyright 2019 Sergey Utkin utkins01@gmail.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   Нагрузочное тестирование: локальный rsync демон на loopback, синтетические модули,
+   сгенерированные конфигурации хостов и запуск pyRsyncBackup.py до завершения одного цикла копирования.
+"""
+import argparse
+import datetime
+import itertools
+import json
+import os
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import time
+from contextlib import closing
+
+# App Lib
+run_dir_name, run_file_name = os.path.split(os.path.abspath(__file__))
+app_dir = os.path.dirname(run_dir_name)
+sys.path.append(os.path.join(app_dir, 'lib'))
+import config as rb_conf
+import database as rb_db
+import log as rb_log
+import resources as rb_resources
+import scheduler as rb_scheduler
+
+RSYNC = '/usr/bin/rsync'
+SHAPES = ['small', 'huge', 'deep']
+METRIC = re.compile(r'^(?P<name>[a-z_]+)(?:\{(?P<labels>[^}]*)\})? (?P<value>\S+)$')
+
+
+def version():
+    try:
+        return subprocess.check_output(['git', '-C', app_dir, 'describe', '--always', '--dirty']).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def write_file(path, size, chunk=1024 * 1024):
+    with open(path, 'wb') as f:
+        while size > 0:
+            f.write(os.urandom(min(chunk, size)))
+            size -= chunk
+
+
+def make_tree(root, shape, size, files):
+    """
+    Дерево модуля заданной формы, общий объём size байт:
+    small - files мелких файлов, huge - files больших файлов, deep - files файлов в каталогах глубиной до 32
+    """
+    if os.path.isdir(root):
+        return
+    tmp = root + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    file_size = max(1, size // files)
+    for i in range(files):
+        if shape == 'deep':
+            directory = os.path.join(tmp, *['d{0}'.format(level) for level in range(i % 32 + 1)])
+        else:
+            directory = os.path.join(tmp, 'd{0}'.format(i // 1000))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        write_file(os.path.join(directory, 'f{0}'.format(i)), file_size)
+    os.rename(tmp, root)
+
+
+def free_port():
+    with closing(socket.socket()) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_daemon(work, data, port):
+    """
+    rsync демон на loopback, модуль bench - каталог с деревьями модулей
+    """
+    conf = os.path.join(work, 'rsyncd.conf')
+    with open(conf, 'w') as f:
+        f.write('use chroot = no\n')
+        f.write('uid = {0}\ngid = {1}\n'.format(os.getuid(), os.getgid()))
+        f.write('max connections = 0\n')
+        f.write('pid file = {0}\n'.format(os.path.join(work, 'rsyncd.pid')))
+        f.write('log file = {0}\n'.format(os.path.join(work, 'rsyncd.log')))
+        f.write('[bench]\npath = {0}\nread only = yes\n'.format(data))
+    process = subprocess.Popen([RSYNC, '--daemon', '--no-detach', '--config', conf,
+                                '--address', '127.0.0.1', '--port', str(port)])
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        sock = socket.socket()
+        try:
+            if sock.connect_ex(('127.0.0.1', port)) == 0:
+                return process
+        finally:
+            sock.close()
+        time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('rsync daemon не запущен')
+
+
+def write_config(path, args, work, threads, modules, tree):
+    lines = [
+        '[Main]',
+        'HostList = {0}'.format(os.path.join(work, 'host.d')),
+        'Threads = {0}'.format(threads),
+        'ModuleConcurrency = {0}'.format(args.module_concurrency),
+        '',
+        '[DataBase]',
+        'Type = {0}'.format(args.db_type),
+        'File = {0}'.format(os.path.join(work, 'state.db')),
+        'Host = {0}'.format(args.db_host),
+        'Port = {0}'.format(args.db_port),
+        'DataBase = {0}'.format(args.db_name),
+        'Login = {0}'.format(args.db_login),
+        'Password = {0}'.format(args.db_password),
+        'HistoryKeep = 0',
+        '',
+        '[Metrics]',
+        'Listen =',
+        'TextFile = {0}'.format(os.path.join(work, 'metrics.prom')),
+        'Interval = 0',
+        '',
+        '[Logging]',
+        'Dir = {0}'.format(os.path.join(work, 'logs')),
+        'Level = {0}'.format(args.log_level),
+        '',
+    ]
+    for i in range(modules):
+        lines += ['[bench_{0}]'.format(i), 'path = /bench/{0}/m{1}/'.format(tree, i), '']
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines))
+
+
+def write_hosts(work, hosts, port):
+    host_dir = os.path.join(work, 'host.d')
+    shutil.rmtree(host_dir, ignore_errors=True)
+    os.makedirs(host_dir)
+    with open(os.path.join(host_dir, 'bench.conf'), 'w') as f:
+        f.write('[Main]\n')
+        f.write('BackupDirectory = {0}\n'.format(os.path.join(work, 'backup')))
+        f.write('BackupInterval = 1d\nDiscoveringInterval = 1d\n\n[Host]\n')
+        for i in range(hosts):
+            f.write('bench{0} = ip=127.0.0.1, port={1}\n'.format(i, port))
+    return os.path.join(host_dir, 'bench.conf')
+
+
+def prepare_database(conf_file, host_file, delay):
+    """
+    Чистая база данных и хосты, запланированные на ближайшее время.
+    Без этого просроченные задания новых хостов распределяются по всему интервалу копирования.
+    """
+    conf = rb_conf.AppConfiguration(conf_file)
+    engine = rb_db.get_engine(conf, 1)
+    rb_db.Base.metadata.drop_all(engine)
+    rb_db.check_database(engine)
+    rb_db.import_host(engine, host_file)
+    start = datetime.datetime.now() + datetime.timedelta(seconds=delay)
+    with rb_db.edit(engine) as dbe:
+        dbe.query(rb_db.Host).update({rb_db.Host.discovering_date: start,
+                                      rb_db.Host.backup_date: start,
+                                      rb_db.Host.retention_date: start + datetime.timedelta(days=1)})
+    engine.dispose()
+
+
+def read_metrics(path):
+    result = {}
+    if not os.path.isfile(path):
+        return result
+    with open(path) as f:
+        for line in f:
+            match = METRIC.match(line.strip())
+            if not match:
+                continue
+            labels = tuple(sorted(re.findall(r'(\w+)="([^"]*)"', match.group('labels') or '')))
+            result[(match.group('name'), labels)] = float(match.group('value'))
+    return result
+
+
+def metric_sum(metrics, name, **labels):
+    return sum(value for (metric, metric_labels), value in metrics.items()
+               if metric == name and all((key, str(val)) in metric_labels for key, val in labels.items()))
+
+
+def run_daemon(args, work, hosts, modules, threads, tree):
+    """
+    Один цикл обнаружения и копирования всех хостов
+    """
+    conf_file = os.path.join(work, 'pyRsyncBackup.conf')
+    metrics_file = os.path.join(work, 'metrics.prom')
+    for name in ['backup', 'logs', metrics_file]:
+        path = os.path.join(work, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.isfile(path):
+            os.remove(path)
+    write_config(conf_file, args, work, threads, modules, tree)
+    host_file = write_hosts(work, hosts, args.port)
+    prepare_database(conf_file, host_file, args.delay)
+
+    start = time.time()
+    process = subprocess.Popen([sys.executable, os.path.join(app_dir, 'pyRsyncBackup.py'), conf_file])
+    metrics = {}
+    try:
+        while time.time() - start < args.timeout:
+            time.sleep(0.5)
+            metrics = read_metrics(metrics_file)
+            if metric_sum(metrics, 'pyrsyncbackup_jobs_total', job=rb_scheduler.BACKUP) >= hosts:
+                break
+            if process.poll() is not None:
+                break
+    finally:
+        wall = time.time() - start - args.delay
+        if process.poll() is None:
+            process.send_signal(signal.SIGTERM)
+            process.wait()
+
+    received = metric_sum(metrics, 'pyrsyncbackup_received_bytes_total')
+    rsync_sum = metric_sum(metrics, 'pyrsyncbackup_phase_duration_seconds_sum', phase='rsync')
+    discovery_sum = metric_sum(metrics, 'pyrsyncbackup_phase_duration_seconds_sum', phase='discovery')
+    discovery_count = metric_sum(metrics, 'pyrsyncbackup_phase_duration_seconds_count', phase='discovery')
+    db_sum = metric_sum(metrics, 'pyrsyncbackup_phase_duration_seconds_sum', phase='db')
+    return {
+        'completed': metric_sum(metrics, 'pyrsyncbackup_jobs_total', job=rb_scheduler.BACKUP, status='success'),
+        'failed': metric_sum(metrics, 'pyrsyncbackup_jobs_total', status='failure'),
+        'wall': wall,
+        'received_bytes': received,
+        'throughput': received / wall if wall > 0 else 0,
+        'rsync_seconds': rsync_sum,
+        'discovery_avg': discovery_sum / discovery_count if discovery_count else None,
+        'db_seconds': db_sum,
+    }
+
+
+class SyncPool:
+    """
+    Пул, выполняющий задание сразу, для измерения накладных расходов планировщика
+    """
+    def apply_async(self, func, args, callback=None, error_callback=None):
+        result = func(*args)
+        if callback:
+            callback(result)
+
+
+class BenchHost:
+    def __init__(self, host_id, backup_directory):
+        self.id = host_id
+        self.name = 'bench{0}'.format(host_id)
+        self.ip = '127.0.0.1'
+        self.port = 873
+        self.proxy = None
+        self.backup_directory = backup_directory
+
+
+def scheduler_overhead(work, hosts, threads):
+    """
+    Время планировщика на одно задание без выполнения самих заданий, секунды
+    """
+    logging = rb_log.Log('bench', os.path.join(work, 'scheduler.log'), 'INFO', 1, 1024 * 1024)
+    jobs = dict((job, lambda host, **kwargs: True) for job in [rb_scheduler.DISCOVERING, rb_scheduler.BACKUP])
+    scheduler = rb_scheduler.Scheduler(SyncPool(), jobs, threads, logging,
+                                       rb_resources.Resources({'destination': 0, 'proxy': 0}))
+    now = datetime.datetime.now()
+    for i in range(hosts):
+        host = BenchHost(i, work)
+        scheduler.add(now, host, rb_scheduler.DISCOVERING)
+        scheduler.add(now, host, rb_scheduler.BACKUP)
+
+    done = 0
+    start = time.time()
+    while len(scheduler) or scheduler.running:
+        scheduler.dispatch(now)
+        done += len(scheduler.completed())
+    return (time.time() - start) / max(done, 1)
+
+
+def compare(old_file, new_file):
+    def load(path):
+        result = {}
+        with open(path) as f:
+            for line in f:
+                item = json.loads(line)
+                result[tuple(item[key] for key in ['shape', 'hosts', 'modules', 'threads'])] = item
+        return result
+
+    old, new = load(old_file), load(new_file)
+    print('{0:<28}{1:>14}{2:>14}{3:>14}{4:>14}'.format('shape/hosts/modules/threads', 'wall', 'wall old',
+                                                      'MB/s', 'MB/s old'))
+    for key in sorted(set(old) & set(new)):
+        print('{0:<28}{1:>14.2f}{2:>14.2f}{3:>14.2f}{4:>14.2f}'.format(
+            '/'.join(str(k) for k in key), new[key]['wall'], old[key]['wall'],
+            new[key]['throughput'] / 1024 / 1024, old[key]['throughput'] / 1024 / 1024))
+
+
+def int_list(value):
+    return [int(item) for item in value.split(',')]
+
+
+parser = argparse.ArgumentParser(description='Нагрузочное тестирование pyRsyncBackup')
+parser.add_argument('--work', default='/tmp/pyRsyncBackupBench', help='рабочий каталог')
+parser.add_argument('--output', default='bench.jsonl', help='файл результатов, одна json запись на запуск')
+parser.add_argument('--shape', choices=SHAPES, default='small')
+parser.add_argument('--size', type=rb_conf.calc_size, default='64M', help='объём одного модуля, суффиксы K, M, G')
+parser.add_argument('--files', type=int, default=1000, help='количество файлов в модуле')
+parser.add_argument('--hosts', type=int_list, default=[1, 4], help='количество хостов, через запятую')
+parser.add_argument('--modules', type=int_list, default=[1, 4], help='количество модулей, через запятую')
+parser.add_argument('--threads', type=int_list, default=[1, 4], help='значения Threads, через запятую')
+parser.add_argument('--module-concurrency', type=int, default=1)
+parser.add_argument('--scheduler-hosts', type=int, default=10000, help='хостов для замера планировщика')
+parser.add_argument('--timeout', type=int, default=3600, help='максимальное время одного запуска, секунды')
+parser.add_argument('--delay', type=int, default=3, help='задержка первого задания после запуска, секунды')
+parser.add_argument('--port', type=int, default=0, help='порт rsync демона, 0 - свободный порт')
+parser.add_argument('--log-level', default='INFO')
+parser.add_argument('--db-type', choices=['sqlite', 'postgresql'], default='sqlite')
+parser.add_argument('--db-host', default='127.0.0.1')
+parser.add_argument('--db-port', default='5432')
+parser.add_argument('--db-name', default='pyRsyncBackupBench', help='отдельная база, таблицы удаляются!')
+parser.add_argument('--db-login', default='pyRsyncBackup')
+parser.add_argument('--db-password', default='123456')
+parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='сравнение двух файлов результатов')
+arguments = parser.parse_args()
+
+if arguments.compare:
+    compare(*arguments.compare)
+    sys.exit(0)
+
+if not os.path.isdir(arguments.work):
+    os.makedirs(arguments.work)
+data_dir = os.path.join(arguments.work, 'data')
+tree_name = '{a.shape}-{a.size}-{a.files}'.format(a=arguments)
+for module_index in range(max(arguments.modules)):
+    make_tree(os.path.join(data_dir, tree_name, 'm{0}'.format(module_index)),
+              arguments.shape, arguments.size, arguments.files)
+
+if not arguments.port:
+    arguments.port = free_port()
+daemon = start_daemon(arguments.work, data_dir, arguments.port)
+try:
+    with open(arguments.output, 'a') as output:
+        for host_count, module_count, thread_count in itertools.product(arguments.hosts, arguments.modules,
+                                                                          arguments.threads):
+            result = {
+                'version': version(),
+                'date': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                'shape': arguments.shape,
+                'size': arguments.size,
+                'files': arguments.files,
+                'hosts': host_count,
+                'modules': module_count,
+                'threads': thread_count,
+                'module_concurrency': arguments.module_concurrency,
+            }
+            result.update(run_daemon(arguments, arguments.work, host_count, module_count, thread_count, tree_name))
+            result['scheduler_job_seconds'] = scheduler_overhead(arguments.work, arguments.scheduler_hosts,
+                                                                 thread_count)
+            output.write(json.dumps(result, sort_keys=True) + '\n')
+            output.flush()
+            print(json.dumps(result, sort_keys=True))
+finally:
+    daemon.terminate()
+    daemon.wait()
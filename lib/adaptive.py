@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    Filename : adaptive
+    Date: 17.10.2026 20:00
+    Project: pyRsyncBackup
+    AUTHOR : Sergey Utkin
+
+    Copyright 2019 Sergey Utkin utkins01@gmail.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import time
+
+import log as rb_log
+import metrics as rb_metrics
+
+
+def cpu_times(path='/proc/stat'):
+    """
+    Общее время процессора и время ожидания ввода-вывода
+    :return: (всего, iowait) или None, если статистика недоступна
+    """
+    try:
+        with open(path) as f:
+            values = [int(value) for value in f.readline().split()[1:]]
+    except (IOError, OSError, ValueError):
+        return None
+    if len(values) < 5:
+        return None
+    return sum(values), values[4]
+
+
+class Controller:
+    """
+    Подбор количества одновременных заданий по принципу AIMD: при наличии очереди количество растёт
+    на единицу за интервал, при признаках перегрузки(ожидание ввода-вывода, рост длительности rsync,
+    падение общей скорости после увеличения) - уменьшается в decrease раз.
+    """
+    def __init__(self, minimum, maximum, interval, logging, iowait=0.3, latency=2.0, decrease=0.5):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.interval = interval
+        self.logging = logging      # type: rb_log.Log
+        self.iowait = iowait
+        self.latency = latency
+        self.decrease = decrease
+
+        self.started = time.time()
+        self.cpu = cpu_times()
+        self.bytes = 0
+        self.rsync = []
+        self.saturated = False
+        self.baseline = None        # средняя длительность rsync без перегрузки
+        self.previous = None        # (количество заданий, скорость) прошлого интервала
+
+    def job(self, result):
+        """
+        Учёт результата задания, формат metrics.Phases.result()
+        """
+        if not isinstance(result, dict):
+            return
+        self.bytes += result['bytes']
+        self.rsync += [seconds for phase, seconds in result['phases'] if phase == rb_metrics.RSYNC]
+
+    def _iowait(self):
+        cpu = cpu_times()
+        if cpu is None or self.cpu is None or cpu[0] == self.cpu[0]:
+            self.cpu = cpu
+            return 0
+        share = float(cpu[1] - self.cpu[1]) / (cpu[0] - self.cpu[0])
+        self.cpu = cpu
+        return share
+
+    def tick(self, scheduler, now=None):
+        """
+        Вызывается в каждом цикле планировщика, раз в interval изменяет scheduler.threads
+        :type scheduler: scheduler.Scheduler
+        """
+        if now is None:
+            now = time.time()
+        # Очередь есть, а все разрешённые процессы заняты
+        if len(scheduler.running) >= scheduler.threads and \
+                [item for item in scheduler.ready if item[2] not in scheduler.running]:
+            self.saturated = True
+        if now - self.started < self.interval:
+            return scheduler.threads
+
+        threads = scheduler.threads
+        rate = self.bytes / (now - self.started)
+        iowait = self._iowait()
+        latency = sum(self.rsync) / len(self.rsync) if self.rsync else None
+
+        reason = None
+        if iowait > self.iowait:
+            reason = 'ожидание ввода-вывода {0:.0%}'.format(iowait)
+        elif latency is not None and self.baseline and latency > self.baseline * self.latency:
+            reason = 'длительность rsync {0:.0f}s, обычно {1:.0f}s'.format(latency, self.baseline)
+        elif self.previous and self.previous[0] < threads and rate < self.previous[1] * 0.9:
+            reason = 'скорость снизилась после увеличения: {0:.0f} -> {1:.0f} байт/с'.format(self.previous[1], rate)
+
+        if reason:
+            threads = max(self.minimum, int(threads * self.decrease))
+        else:
+            if latency is not None:
+                self.baseline = latency if self.baseline is None else 0.8 * self.baseline + 0.2 * latency
+            if self.saturated:
+                threads = min(self.maximum, threads + 1)
+
+        if threads != scheduler.threads:
+            self.logging.info('Adaptive: одновременных заданий {old} -> {new}{reason}'.format(
+                old=scheduler.threads, new=threads, reason=', ' + reason if reason else ''))
+        self.previous = (scheduler.threads, rate)
+        scheduler.threads = threads
+
+        self.started = now
+        self.bytes = 0
+        self.rsync = []
+        self.saturated = False
+        return threads
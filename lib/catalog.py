@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    Filename : catalog
+    Date: 17.10.2026 23:00
+    Project: pyRsyncBackup
+    AUTHOR : Sergey Utkin
+
+    Copyright 2019 Sergey Utkin utkins01@gmail.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import datetime
+import os
+from itertools import groupby
+
+import sqlalchemy
+
+import database as rb_db
+import snapshot as rb_snapshot
+
+NEW = 'new'
+CHANGED = 'changed'
+DELETED = 'deleted'
+
+CHUNK = 1000
+
+Catalog = rb_db.Catalog
+
+
+def change(item):
+    """
+    Тип изменения по строке --itemize-changes, атрибуты и каталоги не учитываются
+    :param item: runner.itemize()
+    :return: NEW, CHANGED, DELETED или None
+    """
+    update, kind, flags, path = item
+    if update == '*':
+        return DELETED
+    if update not in '>c' or kind not in 'fL':
+        return None
+    if flags.startswith('+'):
+        return NEW
+    return CHANGED
+
+
+def source_path(module_path, path):
+    """
+    Путь файла на хосте: без завершающего '/' rsync передаёт каталог модуля вместе с его именем
+    """
+    if not module_path.endswith('/'):
+        module_path = os.path.dirname(module_path)
+    return os.path.join(module_path, path).rstrip('/')
+
+
+def _stat(path):
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return None, None
+    return st.st_size, datetime.datetime.fromtimestamp(st.st_mtime)
+
+
+def record(engine, host_id, module, timestamp, directory, items, date=None):
+    """
+    Запись изменений запуска в каталог файлов частями по CHUNK строк
+    :type module: rb_db.Module
+    :param timestamp: имя каталога запуска(снимок или каталог изменённых файлов режима delta)
+    :param directory: каталог с полученными файлами(снимок или current)
+    :param items: [(тип изменения, путь относительно каталога)]
+    :return: количество записей
+    """
+    if date is None:
+        date = datetime.datetime.now()
+    delta = module.mode != rb_snapshot.SNAPSHOT
+    count = 0
+    for index in range(0, len(items), CHUNK):
+        rows = []
+        displaced = []
+        for kind, path in items[index:index + CHUNK]:
+            size, mtime = (None, None) if kind == DELETED else _stat(os.path.join(directory, path))
+            name = source_path(module.path, path)
+            # Версия файла режима delta хранится в current, предыдущая переносится в каталог запуска
+            if delta and kind != NEW:
+                displaced.append(name)
+            rows.append({'host': host_id, 'module': module.name, 'path': name, 'size': size, 'mtime': mtime,
+                         'change': kind, 'backup_date': date,
+                         'snapshot': rb_snapshot.CURRENT if delta and kind != DELETED else timestamp})
+        with rb_db.edit(engine) as dbe:
+            if displaced:
+                dbe.query(Catalog).filter(Catalog.host == host_id, Catalog.module == module.name,
+                                          Catalog.snapshot == rb_snapshot.CURRENT,
+                                          Catalog.path.in_(displaced)).update(
+                    {Catalog.snapshot: timestamp}, synchronize_session=False)
+            dbe.bulk_insert_mappings(Catalog, rows)
+        count += len(rows)
+    return count
+
+
+def forget(session, host_id, module, names):
+    """
+    Удаление записей каталогов, удалённых политикой хранения
+    """
+    if not names:
+        return 0
+    return session.query(Catalog).filter(Catalog.host == host_id, Catalog.module == module,
+                                         Catalog.snapshot.in_(names)).delete(synchronize_session=False)
+
+
+def merge(session, host_id, module, source, target):
+    """
+    Слияние каталогов изменений: версии source заменяют версии target с тем же путём
+    """
+    replaced = session.query(Catalog.path).filter(Catalog.host == host_id, Catalog.module == module,
+                                                  Catalog.snapshot == source, Catalog.change != DELETED)
+    session.query(Catalog).filter(Catalog.host == host_id, Catalog.module == module, Catalog.snapshot == target,
+                                  Catalog.change != DELETED, Catalog.path.in_(replaced.subquery())
+                                  ).delete(synchronize_session=False)
+    session.query(Catalog).filter(Catalog.host == host_id, Catalog.module == module,
+                                  Catalog.snapshot == source).update({Catalog.snapshot: target},
+                                                                     synchronize_session=False)
+
+
+def since(session, host_id, module):
+    """
+    Дата первой записи каталога модуля или None, если каталог модуля пуст
+    """
+    return session.query(sqlalchemy.func.min(Catalog.backup_date)).filter(
+        Catalog.host == host_id, Catalog.module == module).scalar()
+
+
+def absent(session, host_id, module, date):
+    """
+    Файлы, отсутствовавшие на дату: удалённые до неё или созданные после
+    :type module: rb_db.Module
+    :return: множество путей относительно каталога резервной копии
+    """
+    base = module.path if module.path.endswith('/') else os.path.dirname(module.path)
+    query = session.query(Catalog.path, Catalog.change, Catalog.backup_date).filter(
+        Catalog.host == host_id, Catalog.module == module.name).order_by(Catalog.path, Catalog.backup_date)
+    result = set()
+    for path, rows in groupby(query.yield_per(10000), key=lambda row: row[0]):
+        before = None
+        after = None
+        for name, kind, backup_date in rows:
+            if backup_date <= date:
+                before = kind
+            elif after is None:
+                after = kind
+        if before == DELETED or (before is None and after == NEW):
+            result.add(os.path.relpath(path, base))
+    return result
+
+
+def find(session, path, host=None, module=None, prefix=False, limit=100):
+    """
+    Версии файла по каталогу
+    :param prefix: все файлы, путь которых начинается с path
+    :return: [(хост, модуль, путь, каталог, тип изменения, размер, время изменения, дата копирования)]
+    """
+    query = session.query(rb_db.Host.name, Catalog.module, Catalog.path, Catalog.snapshot, Catalog.change,
+                          Catalog.size, Catalog.mtime, Catalog.backup_date
+                          ).join(rb_db.Host, rb_db.Host.id == Catalog.host)
+    if prefix:
+        path = path.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        query = query.filter(Catalog.path.like(path + '%', escape='\\'))
+    else:
+        query = query.filter(Catalog.path == path)
+    if host is not None:
+        query = query.filter(Catalog.host == host)
+    if module is not None:
+        query = query.filter(Catalog.module == module)
+    return query.order_by(Catalog.path, Catalog.backup_date.desc()).limit(limit).all()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    Filename : cluster
+    Date: 17.10.2026 21:00
+    Project: pyRsyncBackup
+    AUTHOR : Sergey Utkin
+
+    Copyright 2019 Sergey Utkin utkins01@gmail.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import datetime
+import os
+import time
+
+import database as rb_db
+import log as rb_log
+import scheduler as rb_scheduler
+
+
+class Cluster:
+    """
+    Несколько узлов с общей базой данных. Перед запуском задания узел получает аренду хоста:
+    строка хоста блокируется(SELECT ... FOR UPDATE SKIP LOCKED), аренда продлевается, пока задание выполняется.
+    Аренда узла, переставшего продлевать её, истекает через ttl секунд и хост забирает другой узел.
+    """
+    def __init__(self, engine, node, ttl, heartbeat, logging, affinity=None, affinity_delay=0):
+        self.engine = engine
+        self.node = node
+        self.ttl = ttl
+        self.heartbeat_interval = heartbeat
+        self.logging = logging      # type: rb_log.Log
+        self.affinity = [os.path.normpath(path) for path in affinity or []]
+        self.affinity_delay = affinity_delay
+        self.last_heartbeat = 0
+
+    def preferred(self, host):
+        """
+        Каталог резервных копий хоста размещён на предпочтительном для узла хранилище
+        :type host: rb_db.Host
+        """
+        if not self.affinity:
+            return True
+        directory = os.path.normpath(host.backup_directory or '')
+        return any(directory == path or directory.startswith(path + os.sep) for path in self.affinity)
+
+    def claim(self, host, job, now):
+        """
+        Получение аренды хоста для запуска задания
+        :type host: rb_db.Host
+        :return: (аренда получена, актуальная запись хоста, время следующей попытки или None)
+        """
+        retry = now + datetime.timedelta(seconds=self.ttl)
+        with rb_db.edit(self.engine) as dbe:
+            row = dbe.query(rb_db.Host).filter(rb_db.Host.id == host.id).with_for_update(skip_locked=True).first()
+            if row is None:
+                # Строка заблокирована другим узлом, который сейчас получает аренду
+                return False, host, retry
+            dbe.expunge(row)
+            if row.disabled:
+                return False, row, None
+            if row.lease_node and row.lease_node != self.node and row.lease_expires and row.lease_expires > now:
+                return False, row, row.lease_expires
+
+            # Задание могло быть выполнено другим узлом
+            due = rb_scheduler.due_date(row, job) or now
+            if due > now:
+                return False, row, due
+            # Хосты чужого хранилища узел забирает, только если предпочтительный узел не успел
+            if not self.preferred(row) and now < due + datetime.timedelta(seconds=self.affinity_delay):
+                return False, row, due + datetime.timedelta(seconds=self.affinity_delay)
+
+            row.lease_node = self.node
+            row.lease_expires = retry
+            dbe.query(rb_db.Host).filter(rb_db.Host.id == row.id).update(
+                {rb_db.Host.lease_node: self.node, rb_db.Host.lease_expires: retry}, synchronize_session=False)
+        return True, row, None
+
+    def release(self, host_id):
+        with rb_db.edit(self.engine) as dbe:
+            dbe.query(rb_db.Host).filter(rb_db.Host.id == host_id, rb_db.Host.lease_node == self.node).update(
+                {rb_db.Host.lease_node: None, rb_db.Host.lease_expires: None}, synchronize_session=False)
+
+    def release_all(self):
+        """
+        Снятие всех аренд узла, например оставшихся после аварийного завершения
+        """
+        with rb_db.edit(self.engine) as dbe:
+            return dbe.query(rb_db.Host).filter(rb_db.Host.lease_node == self.node).update(
+                {rb_db.Host.lease_node: None, rb_db.Host.lease_expires: None}, synchronize_session=False)
+
+    def heartbeat(self, host_ids, force=False):
+        """
+        Продление аренды хостов, задания которых выполняются
+        """
+        if not force and time.time() - self.last_heartbeat < self.heartbeat_interval:
+            return
+        self.last_heartbeat = time.time()
+        host_ids = list(host_ids)
+        if not host_ids:
+            return
+        expires = datetime.datetime.now() + datetime.timedelta(seconds=self.ttl)
+        with rb_db.edit(self.engine) as dbe:
+            lost = len(host_ids) - dbe.query(rb_db.Host).filter(
+                rb_db.Host.id.in_(host_ids), rb_db.Host.lease_node == self.node).update(
+                {rb_db.Host.lease_expires: expires}, synchronize_session=False)
+        if lost:
+            self.logging.warning('Cluster: узел {node} потерял аренду {count} хостов'.format(node=self.node,
+                                                                                         count=lost))
@@ -21,6 +21,8 @@
    See the License for the specific language governing permissions and
    limitations under the License.
 """
+import socket
+
 import database as rb_db
 try:
     from configparser import ConfigParser
@@ -66,6 +68,7 @@ class AppConfiguration:
     DataBaseFile = False
     BackupInterval = 3600
     Threads = 5
+    ModuleConcurrency = 1
     log = {}
 
     def __init__(self, config_file):
@@ -79,19 +82,137 @@ class AppConfiguration:
 
         self.HostList = self.conf.get("Main", "HostList", fallback=False)
         self.Threads = self.conf.getint("Main", "Threads", fallback=5)
-
+        self.ModuleConcurrency = self.conf.getint("Main", "ModuleConcurrency", fallback=1)
+        self.JobTimeout = calc_size(self.conf.get("Main", "JobTimeout", fallback="0"))
+        self.Jitter = calc_size(self.conf.get("Main", "Jitter", fallback="0"))
+        self.ReportSlots = self.conf.getint("Main", "ReportSlots", fallback=12)
+        self.RetryInterval = calc_size(self.conf.get("Main", "RetryInterval", fallback="5m"))
+        self.CircuitThreshold = self.conf.getint("Main", "CircuitThreshold", fallback=5)
+        self.CircuitProbe = calc_size(self.conf.get("Main", "CircuitProbe", fallback="6h"))
+        self.ProbeTimeout = self.conf.getint("Main", "ProbeTimeout", fallback=3)
+        self.ProbeTTL = calc_size(self.conf.get("Main", "ProbeTTL", fallback="1m"))
+
+        self.VerifyInterval = calc_size(self.conf.get("Verify", "Interval", fallback="7d"))
+        self.VerifyBandwidth = calc_size(self.conf.get("Verify", "Bandwidth", fallback="0"))
+        self.VerifyIdle = str2bool(self.conf.get("Verify", "Idle", fallback="true"))
+
+        # postgresql - сервер базы данных, sqlite - встроенная база данных для одного узла
+        self.DbType = self.conf.get("DataBase", "Type", fallback='postgresql')
+        self.DbFile = self.conf.get("DataBase", "File", fallback='/var/lib/pyRsyncBackup/pyRsyncBackup.db')
+        self.DbTimeout = self.conf.getint("DataBase", "Timeout", fallback=30)
+        self.DbConnectAttempts = self.conf.getint("DataBase", "ConnectAttempts", fallback=5)
         self.DbHost = self.conf.get("DataBase", "Host", fallback='localhost')
         self.DbPort = self.conf.get("DataBase", "Port", fallback=5432)
         self.DbBase = self.conf.get("DataBase", "DataBase", fallback='pyRsyncBackup')
         self.DbLogin = self.conf.get("DataBase", "Login", fallback='pyRsyncBackup')
         self.DbPassword = self.conf.get("DataBase", "Password", fallback='123456')
+        self.DbConnections = self.conf.getint("DataBase", "Connections", fallback=10)
+        self.HistoryKeep = calc_size(self.conf.get("DataBase", "HistoryKeep", fallback="90d"))
+
+        self.Resources = {
+            'destination': self.conf.getint("Resources", "Destination", fallback=0),
+            'proxy': self.conf.getint("Resources", "Proxy", fallback=0),
+            'verify': self.conf.getint("Verify", "Threads", fallback=1),
+            'dedup': 1,
+            'replica': self.conf.getint("Replica", "Threads", fallback=1)
+        }
+        self.Bandwidth = calc_size(self.conf.get("Resources", "Bandwidth", fallback="0"))
+
+        # Политика хранения в формате retention модуля: KeepDaily=7, MaxAge=90d
+        self.Retention = ', '.join(
+            '{0}={1}'.format(key, self.conf.get("Retention", key))
+            for key in ['KeepHourly', 'KeepDaily', 'KeepWeekly', 'KeepMonthly', 'MaxAge', 'MaxSize']
+            if self.conf.has_option("Retention", key))
+        self.RetentionInterval = calc_size(self.conf.get("Retention", "Interval", fallback="1h"))
+        self.RetentionThreads = self.conf.getint("Retention", "Threads", fallback=2)
+
+        self.Dedup = str2bool(self.conf.get("Dedup", "Enabled", fallback="false"))
+        self.DedupInterval = calc_size(self.conf.get("Dedup", "Interval", fallback="1h"))
+        self.DedupMinSize = calc_size(self.conf.get("Dedup", "MinSize", fallback="4K"))
+        self.DedupReflink = str2bool(self.conf.get("Dedup", "Reflink", fallback="true"))
+
+        self.ReplicaBatchDir = self.conf.get("Replica", "BatchDir", fallback="/var/lib/pyRsyncBackup/batch")
+        self.ReplicaInterval = calc_size(self.conf.get("Replica", "Interval", fallback="1h"))
+
+        self.Catalog = str2bool(self.conf.get("Catalog", "Enabled", fallback="false"))
+
+        self.TunnelKeepAlive = calc_size(self.conf.get("Tunnel", "KeepAlive", fallback="30"))
+        self.TunnelIdleTimeout = calc_size(self.conf.get("Tunnel", "IdleTimeout", fallback="5m"))
+
+        self.Cluster = str2bool(self.conf.get("Cluster", "Enabled", fallback="false"))
+        self.ClusterNode = self.conf.get("Cluster", "Node", fallback=socket.gethostname())
+        self.ClusterLeaseTTL = calc_size(self.conf.get("Cluster", "LeaseTTL", fallback="5m"))
+        self.ClusterHeartbeat = calc_size(self.conf.get("Cluster", "Heartbeat", fallback="1m"))
+        self.ClusterAffinity = [path.strip() for path in self.conf.get("Cluster", "Affinity", fallback="").split(',')
+                                if path.strip()]
+        self.ClusterAffinityDelay = calc_size(self.conf.get("Cluster", "AffinityDelay", fallback="10m"))
+
+        self.Adaptive = str2bool(self.conf.get("Adaptive", "Enabled", fallback="false"))
+        self.AdaptiveMin = self.conf.getint("Adaptive", "MinThreads", fallback=1)
+        self.AdaptiveMax = self.conf.getint("Adaptive", "MaxThreads", fallback=self.Threads)
+        self.AdaptiveInterval = calc_size(self.conf.get("Adaptive", "Interval", fallback="5m"))
+        self.AdaptiveIOWait = self.conf.getint("Adaptive", "IOWait", fallback=30) / 100.0
+        self.AdaptiveLatency = self.conf.getfloat("Adaptive", "Latency", fallback=2.0)
+
+        # Адрес HTTP сервера метрик в формате host:port, пустое значение - сервер не запускается
+        listen = self.conf.get("Metrics", "Listen", fallback="")
+        self.MetricsListen = None
+        if listen:
+            address, port = listen.rsplit(':', 1)
+            self.MetricsListen = (address, int(port))
+        self.MetricsTextFile = self.conf.get("Metrics", "TextFile", fallback="")
+        self.MetricsInterval = calc_size(self.conf.get("Metrics", "Interval", fallback="30"))
+
+    def pool_size(self):
+        """
+        Количество процессов пула, в адаптивном режиме - максимальное количество заданий
+        """
+        if self.Adaptive:
+            return max(self.AdaptiveMax, self.AdaptiveMin, 1)
+        return self.Threads
+
+    def bwlimit(self, concurrency=1, verify=False):
+        """
+        Доля общей полосы пропускания на один процесс rsync, KB/s
+        :param verify: дополнительное ограничение проверочных запусков
+        """
+        limits = []
+        if self.Bandwidth:
+            limits.append(self.Bandwidth // 1024 // (self.pool_size() * concurrency))
+        if verify and self.VerifyBandwidth:
+            limits.append(self.VerifyBandwidth // 1024 // concurrency)
+        if not limits:
+            return None
+        return max(1, min(limits))
+
+    def limit_pool(self):
+        """
+        Ограничение количества процессов пула лимитом соединений с базой данных:
+        два соединения остаются за основным процессом, каждому процессу пула нужно ModuleConcurrency + 1
+        соединений - по одному на поток модуля и одно для записей задания хоста
+        :return: прежнее количество процессов, если оно уменьшено, иначе None
+        """
+        limit = max((self.DbConnections - 2) // (max(self.ModuleConcurrency, 1) + 1), 1)
+        size = self.pool_size()
+        if size <= limit:
+            return None
+        self.Threads = min(self.Threads, limit)
+        self.AdaptiveMin = min(self.AdaptiveMin, limit)
+        self.AdaptiveMax = min(self.AdaptiveMax, limit)
+        return size
+
+    def worker_connections(self):
+        # Два соединения остаются за основным процессом, остальные делятся между процессами пула(limit_pool)
+        return max(max(self.ModuleConcurrency, 1) + 1, (self.DbConnections - 2) // self.pool_size())
 
     def __repr__(self):
         return "%s(%r)" % (self.__class__, self.__dict__)
 
     def load_modules(self, engine):
+        names = []
         for item in self.conf.sections():
-            if item == 'Main' or item == 'Logging' or item == 'DataBase':
+            if item in ['Main', 'Logging', 'DataBase', 'Resources', 'Retention', 'Tunnel', 'Metrics', 'Adaptive',
+                        'Verify', 'Cluster', 'Dedup', 'Catalog', 'Replica']:
                 pass
             else:
                 module = rb_db.Module()
@@ -99,6 +220,16 @@ class AppConfiguration:
                 module.path = self.conf.get(item, 'path')
                 module.include = self.conf.get(item, 'include', fallback=None)
                 module.exclude = self.conf.get(item, 'exclude', fallback=None)
+                module.mode = self.conf.get(item, 'mode', fallback='delta')
+                module.retention = self.conf.get(item, 'retention', fallback=None)
+                module.verify = self.conf.get(item, 'verify', fallback=None)
+                module.replica = self.conf.get(item, 'replica', fallback=None)
+                module.disabled = False
+                names.append(module.name)
                 with rb_db.edit(engine) as db:
-                    db.add(module)
-        pass
+                    db.merge(module)
+
+        # Модули, удалённые из конфигурации, отключаются
+        with rb_db.edit(engine) as db:
+            db.query(rb_db.Module).filter(~rb_db.Module.name.in_(names)).update(
+                {rb_db.Module.disabled: True}, synchronize_session=False)
@@ -22,9 +22,13 @@
    limitations under the License.
 """
 import datetime
+import fcntl
+import os
+import time
 
 import sqlalchemy
 import sqlalchemy.exc as sql_exc
+from sqlalchemy import event
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from contextlib import contextmanager
@@ -34,22 +38,99 @@ import error as rb_error
 
 Base = declarative_base()
 
+POSTGRESQL = 'postgresql'
+SQLITE = 'sqlite'
+
+# Фабрики сессий, создаются один раз на engine
+_sessions = {}
+# Файлы блокировки записи встроенной базы данных
+_locks = {}
+
+
+def _sqlite_connect(connection, record):
+    cursor = connection.cursor()
+    # WAL: чтение не блокируется записью, синхронизация с диском только при контрольных точках
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+
+def get_engine(conf, pool_size=5):
+    """
+    Подключение к базе данных с ограниченным пулом соединений
+    :type conf: config.AppConfiguration
+    """
+    if conf.DbType == SQLITE:
+        if not os.path.isdir(os.path.dirname(os.path.abspath(conf.DbFile))):
+            os.makedirs(os.path.dirname(os.path.abspath(conf.DbFile)))
+        engine = sqlalchemy.create_engine('sqlite:///{0}'.format(os.path.abspath(conf.DbFile)),
+                                          connect_args={'timeout': conf.DbTimeout})
+        event.listen(engine, 'connect', _sqlite_connect)
+        _locks[engine] = os.path.abspath(conf.DbFile) + '.lock'
+        return engine
+
+    return sqlalchemy.create_engine(
+        'postgresql://{c.DbLogin}:{c.DbPassword}@{c.DbHost}:{c.DbPort}/{c.DbBase}'.format(c=conf),
+        pool_size=pool_size,
+        max_overflow=0,
+        pool_pre_ping=True,
+        connect_args={'connect_timeout': conf.DbTimeout}
+    )
+
+
+def session_factory(engine):
+    if engine not in _sessions:
+        _sessions[engine] = sessionmaker(bind=engine)
+    return _sessions[engine]
+
 
 @contextmanager
 def select(engine):
-    cl_session = sessionmaker(bind=engine)
-    session = cl_session()
+    session = session_factory(engine)()
     yield session
     session.close()
 
 
 @contextmanager
 def edit(engine):
-    cl_session = sessionmaker(bind=engine)
-    session = cl_session()
-    yield session
-    session.commit()
-    session.close()
+    # Встроенная база данных: запись всех процессов и потоков выполняется по очереди
+    lock = None
+    if engine in _locks:
+        lock = open(_locks[engine], 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+    session = session_factory(engine)()
+    try:
+        yield session
+        session.commit()
+    finally:
+        session.close()
+        if lock:
+            lock.close()
+
+
+@contextmanager
+def exclusive(engine, key=0x70795262):
+    """
+    Блокировка на время синхронизации конфигурации, когда несколько узлов используют одну базу данных
+    """
+    if engine in _locks:
+        lock = open(_locks[engine] + '.sync', 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            lock.close()
+        return
+
+    connection = engine.connect()
+    try:
+        connection.execute(sqlalchemy.text('SELECT pg_advisory_lock(:key)'), key=key)
+        try:
+            yield
+        finally:
+            connection.execute(sqlalchemy.text('SELECT pg_advisory_unlock(:key)'), key=key)
+    finally:
+        connection.close()
 
 
 class Module(Base):
@@ -59,6 +140,10 @@ class Module(Base):
     exclude = sqlalchemy.Column(sqlalchemy.String)
     include = sqlalchemy.Column(sqlalchemy.String)
     disabled = sqlalchemy.Column(sqlalchemy.Boolean, default=False)
+    mode = sqlalchemy.Column(sqlalchemy.String, default='delta')
+    retention = sqlalchemy.Column(sqlalchemy.String, default=None)
+    verify = sqlalchemy.Column(sqlalchemy.String, default=None)
+    replica = sqlalchemy.Column(sqlalchemy.String, default=None)
 
     def __repr__(self):
         return "{0}".format(self.__dict__)
@@ -88,6 +173,14 @@ class Host(Base):
     disabled = sqlalchemy.Column(sqlalchemy.Boolean, default=False)
     user = sqlalchemy.Column(sqlalchemy.String, default=None)
     password = sqlalchemy.Column(sqlalchemy.String, default=None)
+    module_concurrency = sqlalchemy.Column(sqlalchemy.Integer, default=None)
+    retention_date = sqlalchemy.Column(sqlalchemy.DateTime, default=datetime.datetime.now)
+    failures = sqlalchemy.Column(sqlalchemy.Integer, default=0)
+    verify_date = sqlalchemy.Column(sqlalchemy.DateTime, default=datetime.datetime.now)
+    lease_node = sqlalchemy.Column(sqlalchemy.String, default=None)
+    lease_expires = sqlalchemy.Column(sqlalchemy.DateTime, default=None)
+    dedup_date = sqlalchemy.Column(sqlalchemy.DateTime, default=datetime.datetime.now)
+    replica_date = sqlalchemy.Column(sqlalchemy.DateTime, default=datetime.datetime.now)
 
     def __repr__(self):
         return "{0}".format(self.__dict__)
@@ -119,6 +212,8 @@ class Host(Base):
                 self.password = val
             elif key == 'User':
                 self.user = val
+            elif key == 'ModuleConcurrency':
+                self.module_concurrency = val
 
 
 class Proxy(Base):
@@ -148,6 +243,10 @@ class ActiveModules(Base):
     host = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
     module = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
     discovering_date = sqlalchemy.Column(sqlalchemy.DateTime, default=datetime.datetime.now)
+    duration = sqlalchemy.Column(sqlalchemy.Float, default=None)
+    failures = sqlalchemy.Column(sqlalchemy.Integer, default=0)
+    next_date = sqlalchemy.Column(sqlalchemy.DateTime, default=None)
+    verify_date = sqlalchemy.Column(sqlalchemy.DateTime, default=None)
 
     def __eq__(self, other):
         if not isinstance(other, self.__class__):
@@ -162,36 +261,226 @@ class ActiveModules(Base):
         return "{0}".format(self.__dict__)
 
 
+class BackupRun(Base):
+    """
+    История запусков резервного копирования модулей, статистика rsync --stats
+    """
+    __tablename__ = "backup_run"
+    __table_args__ = (
+        sqlalchemy.Index('backup_run_host_module_date', 'host', 'module', 'start_date'),
+        sqlalchemy.Index('backup_run_date', 'start_date'),
+    )
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    host = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    module = sqlalchemy.Column(sqlalchemy.String, nullable=False)
+    mode = sqlalchemy.Column(sqlalchemy.String)
+    start_date = sqlalchemy.Column(sqlalchemy.DateTime, nullable=False)
+    duration = sqlalchemy.Column(sqlalchemy.Float)
+    tunnel_time = sqlalchemy.Column(sqlalchemy.Float)
+    returncode = sqlalchemy.Column(sqlalchemy.Integer)
+    timed_out = sqlalchemy.Column(sqlalchemy.Boolean, default=False)
+    success = sqlalchemy.Column(sqlalchemy.Boolean, default=False)
+    files = sqlalchemy.Column(sqlalchemy.BigInteger)
+    files_transferred = sqlalchemy.Column(sqlalchemy.BigInteger)
+    total_size = sqlalchemy.Column(sqlalchemy.BigInteger)
+    transferred_size = sqlalchemy.Column(sqlalchemy.BigInteger)
+    literal_data = sqlalchemy.Column(sqlalchemy.BigInteger)
+    matched_data = sqlalchemy.Column(sqlalchemy.BigInteger)
+    bytes_sent = sqlalchemy.Column(sqlalchemy.BigInteger)
+    bytes_received = sqlalchemy.Column(sqlalchemy.BigInteger)
+    verify = sqlalchemy.Column(sqlalchemy.Boolean, default=False)
+    drift = sqlalchemy.Column(sqlalchemy.Integer)
+
+    def __repr__(self):
+        return "{0}".format(self.__dict__)
+
+
+class Catalog(Base):
+    """
+    Каталог файлов: версии файлов, полученные каждым запуском(rsync --itemize-changes)
+    """
+    __tablename__ = "catalog"
+    __table_args__ = (
+        sqlalchemy.Index('catalog_path', 'path', 'backup_date'),
+        sqlalchemy.Index('catalog_host_module_path', 'host', 'module', 'path'),
+        sqlalchemy.Index('catalog_host_module_snapshot', 'host', 'module', 'snapshot'),
+    )
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    host = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    module = sqlalchemy.Column(sqlalchemy.String, nullable=False)
+    snapshot = sqlalchemy.Column(sqlalchemy.String, nullable=False)
+    path = sqlalchemy.Column(sqlalchemy.String, nullable=False)
+    size = sqlalchemy.Column(sqlalchemy.BigInteger)
+    mtime = sqlalchemy.Column(sqlalchemy.DateTime)
+    change = sqlalchemy.Column(sqlalchemy.String(8))
+    backup_date = sqlalchemy.Column(sqlalchemy.DateTime, nullable=False)
+
+    def __repr__(self):
+        return "{0}".format(self.__dict__)
+
+
+class ReplicaQueue(Base):
+    """
+    Пакеты rsync --write-batch, ожидающие применения к реплике модуля
+    """
+    __tablename__ = "replica_queue"
+    __table_args__ = (
+        sqlalchemy.Index('replica_queue_host', 'host', 'id'),
+    )
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    host = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    module = sqlalchemy.Column(sqlalchemy.String, nullable=False)
+    timestamp = sqlalchemy.Column(sqlalchemy.String, nullable=False)
+    batch = sqlalchemy.Column(sqlalchemy.String)
+    base = sqlalchemy.Column(sqlalchemy.String)
+    create_date = sqlalchemy.Column(sqlalchemy.DateTime)
+
+    def __repr__(self):
+        return "{0}".format(self.__dict__)
+
+
+class Content(Base):
+    """
+    Индекс дедупликации: канонический файл для содержимого на файловой системе
+    """
+    __tablename__ = "content"
+    digest = sqlalchemy.Column(sqlalchemy.String(64), primary_key=True)
+    device = sqlalchemy.Column(sqlalchemy.BigInteger, primary_key=True, autoincrement=False)
+    path = sqlalchemy.Column(sqlalchemy.String, nullable=False)
+    inode = sqlalchemy.Column(sqlalchemy.BigInteger)
+    size = sqlalchemy.Column(sqlalchemy.BigInteger)
+    mtime = sqlalchemy.Column(sqlalchemy.BigInteger)
+    # Файл каталога current режима delta, изменяется rsync на месте
+    mutable = sqlalchemy.Column(sqlalchemy.Boolean)
+
+    def __repr__(self):
+        return "{0}".format(self.__dict__)
+
+
+class DedupQueue(Base):
+    """
+    Файлы, полученные rsync и ожидающие дедупликации
+    """
+    __tablename__ = "dedup_queue"
+    __table_args__ = (
+        sqlalchemy.Index('dedup_queue_host', 'host', 'id'),
+    )
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    host = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    path = sqlalchemy.Column(sqlalchemy.String, nullable=False)
+    mutable = sqlalchemy.Column(sqlalchemy.Boolean)
+
+
+class DedupRun(Base):
+    """
+    История запусков дедупликации
+    """
+    __tablename__ = "dedup_run"
+    __table_args__ = (
+        sqlalchemy.Index('dedup_run_date', 'start_date'),
+    )
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    host = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    start_date = sqlalchemy.Column(sqlalchemy.DateTime, nullable=False)
+    duration = sqlalchemy.Column(sqlalchemy.Float)
+    files = sqlalchemy.Column(sqlalchemy.BigInteger)
+    linked = sqlalchemy.Column(sqlalchemy.BigInteger)
+    reflinked = sqlalchemy.Column(sqlalchemy.BigInteger)
+    saved = sqlalchemy.Column(sqlalchemy.BigInteger)
+
+    def __repr__(self):
+        return "{0}".format(self.__dict__)
+
+
+def prune_history(engine, keep):
+    """
+    Удаление истории запусков старше keep секунд
+    :return: количество удалённых записей
+    """
+    if not keep:
+        return 0
+    limit = datetime.datetime.now() - datetime.timedelta(seconds=keep)
+    with edit(engine) as dbe:
+        dbe.query(DedupRun).filter(DedupRun.start_date < limit).delete(synchronize_session=False)
+        return dbe.query(BackupRun).filter(BackupRun.start_date < limit).delete(synchronize_session=False)
+
+
+def host_modules(session, host_id):
+    """
+    Активные модули хоста вместе с параметрами модулей одним запросом
+    :return: [(ActiveModules, Module)]
+    """
+    return session.query(ActiveModules, Module).join(
+        Module, Module.name == ActiveModules.module
+    ).filter(ActiveModules.host == host_id, Module.disabled == False).all()
+
+
+def discovery_modules(session, host_id):
+    """
+    Все включенные модули и признак их наличия на хосте одним запросом
+    :return: [(Module, ActiveModules или None)]
+    """
+    return session.query(Module, ActiveModules).outerjoin(
+        ActiveModules, sqlalchemy.and_(ActiveModules.module == Module.name, ActiveModules.host == host_id)
+    ).filter(Module.disabled == False).all()
+
+
+def save_discovery(session, host_id, found, active):
+    """
+    Запись результата обнаружения хоста: удаление отсутствующих и добавление новых модулей
+    :param found: имена найденных модулей
+    :param active: имена модулей, уже известных для хоста
+    """
+    if found:
+        session.query(ActiveModules).filter(ActiveModules.host == host_id, ~ActiveModules.module.in_(found)).delete(
+            synchronize_session=False)
+    else:
+        session.query(ActiveModules).filter(ActiveModules.host == host_id).delete(synchronize_session=False)
+    session.bulk_insert_mappings(ActiveModules, [{'host': host_id, 'module': name, 'failures': 0}
+                                                 for name in found if name not in active])
+
+
 def create(engine):
     Base.metadata.create_all(engine)
 
 
-def check_database(engine):
+def upgrade(engine):
+    """
+    Добавление в существующие таблицы отсутствующих колонок
+    :type engine: sqlalchemy.create_engine
+    """
+    inspector = sqlalchemy.inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        columns = [column['name'] for column in inspector.get_columns(table.name)]
+        for column in table.columns:
+            if column.name not in columns:
+                engine.execute('ALTER TABLE {table} ADD COLUMN {column} {type}'.format(
+                    table=table.name, column=column.name, type=column.type.compile(engine.dialect)))
+
+
+def check_database(engine, attempts=1, delay=5):
     """
     Проверка базы данных
     :type engine: sqlalchemy.create_engine
+    :param attempts: количество попыток подключения, сервер базы данных может запускаться дольше приложения
     """
     # Тестирование подключения к Базе данных
-    try:
-        connection = engine.connect()
-        connection.execute("select datname from pg_database;")
-        connection.close()
-    except sql_exc.DisconnectionError, sql_exc.TimeoutError:
-        raise rb_error.RBError('Ошибка подключения к базе данных: {}'.format(engine))
-    except sql_exc.NoSuchTableError:
-        raise rb_error.RBError('Ошибка при проверке базы данных: {}'.format(engine))
+    for attempt in range(attempts):
+        try:
+            connection = engine.connect()
+            connection.execute("select 1")
+            connection.close()
+            break
+        except (sql_exc.OperationalError, sql_exc.DisconnectionError, sql_exc.TimeoutError):
+            if attempt + 1 >= attempts:
+                raise rb_error.RBError('Ошибка подключения к базе данных: {}'.format(engine))
+            time.sleep(delay)
+        except sql_exc.NoSuchTableError:
+            raise rb_error.RBError('Ошибка при проверке базы данных: {}'.format(engine))
 
     # Создание структуры приложения
     create(engine)
-
-    # Очищаем таблицы и сбрасываем seq
-    with edit(engine) as dbe:
-        dbe.query(Proxy).delete()
-        dbe.query(ActiveModules).delete()
-        dbe.query(Host).delete()
-        dbe.query(Module).delete()
-        dbe.execute("ALTER SEQUENCE host_id_seq RESTART WITH 1;")
-        dbe.execute("ALTER SEQUENCE proxy_id_seq RESTART WITH 1;")
+    upgrade(engine)
 
 
 def import_host(engine, conf):
@@ -208,26 +497,30 @@ def import_host(engine, conf):
     discovering_interval = config.get('Main', 'DiscoveringInterval', fallback=None)
     user = config.get('Main', 'User', fallback=None)
     password_file = config.get('Main', 'PasswordFile', fallback=None)
+    module_concurrency = config.get('Main', 'ModuleConcurrency', fallback=None)
     proxy_id = None
 
     if config.has_section('Proxy'):
-        proxy = Proxy()
-        proxy.ip = config.get('Proxy', 'ip', fallback=None)
-        proxy.port = config.get('Proxy', 'port', fallback=22)
-        proxy.login = config.get('Proxy', 'login', fallback=None)
-        proxy.password = config.get('Proxy', 'password', fallback=None)
+        ip = config.get('Proxy', 'ip', fallback=None)
+        port = int(config.get('Proxy', 'port', fallback=22))
+        login = config.get('Proxy', 'login', fallback=None)
 
-        if not proxy.ip:
+        if not ip:
             raise rb_error.RBError('Не полная информация о Proxy сервере: {file}'.format(file=conf))
         else:
             with edit(engine) as db:
-                db.add(proxy)
+                proxy = db.query(Proxy).filter(Proxy.ip == ip, Proxy.port == port, Proxy.login == login).first()
+                if proxy is None:
+                    proxy = Proxy(ip=ip, port=port, login=login)
+                    db.add(proxy)
+                proxy.password = config.get('Proxy', 'password', fallback=None)
                 db.flush()
                 db.refresh(proxy)
                 proxy_id = proxy.id
     if not config.has_section('Host'):
         raise rb_error.RBError('Отсутствует секция "Host" в конфигурационном файле: {file}'.format(file=conf))
 
+    names = []
     for item in config.items('Host', True):
         host = Host()
         host.name = item[0]
@@ -237,6 +530,28 @@ def import_host(engine, conf):
         host.proxy = proxy_id
         host.user = user
         host.password = password_file
+        host.module_concurrency = module_concurrency
         host.load(item[1])
+        host.port = int(host.port or 873)
+        names.append(host.name)
         with edit(engine) as db:
-            db.add(host)
+            exists = db.query(Host).filter(Host.name == host.name).first()
+            if exists is None:
+                db.add(host)
+                continue
+            # Сроки заданий и результаты обнаружения сохраняются, обновляются только параметры хоста
+            for column in ['ip', 'port', 'backup_directory', 'backup_interval', 'discovering_interval', 'proxy',
+                           'user', 'password', 'module_concurrency']:
+                setattr(exists, column, getattr(host, column))
+            exists.disabled = False
+    return names
+
+
+def disable_hosts(engine, names):
+    """
+    Отключение хостов, отсутствующих в конфигурации
+    :return: количество отключенных хостов
+    """
+    with edit(engine) as dbe:
+        return dbe.query(Host).filter(Host.disabled == False, ~Host.name.in_(names)).update(
+            {Host.disabled: True}, synchronize_session=False)
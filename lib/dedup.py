@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    Filename : dedup
+    Date: 17.10.2026 22:00
+    Project: pyRsyncBackup
+    AUTHOR : Sergey Utkin
+
+    Copyright 2019 Sergey Utkin utkins01@gmail.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import errno
+import fcntl
+import hashlib
+import os
+import stat
+
+import database as rb_db
+import log as rb_log
+
+# ioctl FICLONE(linux/fs.h): общие блоки данных у двух файлов, поддерживается btrfs, xfs
+FICLONE = 0x40049409
+BLOCK = 1024 * 1024
+SUFFIX = '.dedup'
+
+
+def file_hash(path):
+    """
+    sha256 содержимого файла
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(BLOCK)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def same_metadata(a, b):
+    """
+    Жёсткая ссылка общая для атрибутов файла, поэтому допустима только при их совпадении
+    """
+    return a.st_mode == b.st_mode and a.st_uid == b.st_uid and a.st_gid == b.st_gid and \
+        int(a.st_mtime) == int(b.st_mtime)
+
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def hardlink(source, inode, path):
+    """
+    Замена файла жёсткой ссылкой на source
+    :param inode: ожидаемый inode source, файл мог быть заменён rsync после проверки
+    :return: файл заменён
+    """
+    tmp = path + SUFFIX
+    _remove(tmp)
+    os.link(source, tmp)
+    try:
+        if os.lstat(tmp).st_ino != inode:
+            _remove(tmp)
+            return False
+        os.rename(tmp, path)
+    except OSError:
+        _remove(tmp)
+        raise
+    return True
+
+
+def reflink(source, inode, path, st):
+    """
+    Замена файла копией source с общими блоками данных, атрибуты файла сохраняются
+    :type st: os.stat_result
+    :return: файл заменён, False - файловая система не поддерживает reflink
+    """
+    tmp = path + SUFFIX
+    _remove(tmp)
+    with open(source, 'rb') as src:
+        if os.fstat(src.fileno()).st_ino != inode:
+            return False
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            fcntl.ioctl(fd, FICLONE, src.fileno())
+        except (IOError, OSError):
+            os.close(fd)
+            _remove(tmp)
+            return False
+        os.close(fd)
+    try:
+        os.chown(tmp, st.st_uid, st.st_gid)
+        os.chmod(tmp, stat.S_IMODE(st.st_mode))
+        os.utime(tmp, (st.st_atime, st.st_mtime))
+        os.rename(tmp, path)
+    except OSError:
+        _remove(tmp)
+        raise
+    return True
+
+
+class Dedup:
+    """
+    Дедупликация хранилища резервных копий между хостами и снимками.
+    Хешируются только файлы, полученные rsync(очередь dedup_queue), индекс content хранит для каждого
+    содержимого канонический файл на файловой системе. Жёсткой ссылкой заменяются только файлы неизменяемых
+    снимков с совпадающими атрибутами: rsync меняет права и владельца файла current режима delta на месте,
+    что изменило бы все связанные копии. Остальные дубликаты заменяются reflink копией.
+    """
+    def __init__(self, engine, logging, min_size=4096, use_reflink=True, batch=500):
+        self.engine = engine
+        self.logging = logging      # type: rb_log.Log
+        self.min_size = min_size
+        self.use_reflink = use_reflink
+        self.batch = batch
+
+    def _files(self, rows):
+        """
+        Хеширование файлов очереди
+        :return: [(путь, os.stat_result, хеш, файл изменяемый)]
+        """
+        files = []
+        for row in rows:
+            try:
+                st = os.lstat(row.path)
+                if not stat.S_ISREG(st.st_mode) or st.st_size < self.min_size:
+                    continue
+                digest = file_hash(row.path)
+                # Файл изменён во время хеширования
+                after = os.lstat(row.path)
+            except (IOError, OSError):
+                continue
+            if (after.st_ino, after.st_size, after.st_mtime) != (st.st_ino, st.st_size, st.st_mtime):
+                continue
+            # Строки очереди до появления признака считаются изменяемыми
+            files.append((row.path, st, digest, row.mutable is not False))
+        return files
+
+    @staticmethod
+    def _valid(content):
+        """
+        Канонический файл существует и не изменён
+        :type content: rb_db.Content
+        """
+        try:
+            st = os.lstat(content.path)
+        except OSError:
+            return None
+        if st.st_ino != content.inode or st.st_size != content.size or int(st.st_mtime) != content.mtime:
+            return None
+        return st
+
+    def _link(self, content, canonical, path, st, mutable):
+        """
+        :param mutable: файл изменяемый(current режима delta)
+        :return: 'link', 'reflink' или None
+        """
+        try:
+            if not mutable and content.mutable is False and same_metadata(canonical, st):
+                if hardlink(content.path, content.inode, path):
+                    return 'link'
+                return None
+            if self.use_reflink and reflink(content.path, content.inode, path, st):
+                return 'reflink'
+        except (IOError, OSError) as e:
+            if e.errno != errno.EMLINK:
+                self.logging.warning('Dedup: {path} - {e}'.format(path=path, e=e))
+            raise
+        return None
+
+    def step(self, host_id):
+        """
+        Обработка очередной части очереди хоста
+        :return: {'files': , 'linked': , 'reflinked': , 'saved': } или None, если очередь пуста
+        """
+        with rb_db.select(self.engine) as db:
+            rows = db.query(rb_db.DedupQueue).filter(rb_db.DedupQueue.host == host_id).order_by(
+                rb_db.DedupQueue.id).limit(self.batch).all()
+        if not rows:
+            return None
+
+        files = self._files(rows)
+        with rb_db.select(self.engine) as db:
+            index = dict(((content.digest, content.device), content) for content in db.query(rb_db.Content).filter(
+                rb_db.Content.digest.in_(set(item[2] for item in files))).all()) if files else {}
+
+        def canonical_file(path, st, digest, mutable):
+            return rb_db.Content(digest=digest, device=st.st_dev, path=path, inode=st.st_ino, size=st.st_size,
+                                 mtime=int(st.st_mtime), mutable=mutable)
+
+        result = {'files': len(files), 'linked': 0, 'reflinked': 0, 'saved': 0}
+        changed = {}
+        for path, st, digest, mutable in files:
+            key = (digest, st.st_dev)
+            content = changed.get(key) or index.get(key)
+            canonical = self._valid(content) if content else None
+            if canonical is None:
+                changed[key] = canonical_file(path, st, digest, mutable)
+                continue
+            if canonical.st_ino == st.st_ino:
+                continue
+            try:
+                action = self._link(content, canonical, path, st, mutable)
+            except (IOError, OSError) as e:
+                # Превышено количество ссылок на inode - файл становится новым каноническим
+                if e.errno == errno.EMLINK:
+                    changed[key] = canonical_file(path, st, digest, mutable)
+                continue
+            # Канонический файл из current заменяется файлом снимка, чтобы следующие копии снимков
+            # заменялись жёсткими ссылками
+            if content.mutable is not False and not mutable:
+                try:
+                    changed[key] = canonical_file(path, os.lstat(path), digest, mutable)
+                except OSError:
+                    pass
+            if action is None:
+                continue
+            result['linked' if action == 'link' else 'reflinked'] += 1
+            # Место освобождается, только если на заменённый inode не было других ссылок
+            if st.st_nlink == 1:
+                result['saved'] += st.st_blocks * 512
+
+        with rb_db.edit(self.engine) as dbe:
+            for content in changed.values():
+                dbe.merge(content)
+            dbe.query(rb_db.DedupQueue).filter(rb_db.DedupQueue.id.in_([row.id for row in rows])).delete(
+                synchronize_session=False)
+        return result
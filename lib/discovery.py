@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    Filename : discovery
+    Date: 17.10.2026 11:00
+    Project: pyRsyncBackup
+    AUTHOR : Sergey Utkin
+
+    Copyright 2019 Sergey Utkin utkins01@gmail.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import re
+
+import database as rb_db
+import log as rb_log
+import runner as rb_runner
+
+RSYNC = '/usr/bin/rsync'
+
+# rsync: change_dir "/sysconfig/network-scripts" (in etc) failed: No such file or directory (2)
+ERROR_PATH = re.compile(r'"(?P<path>[^"]*)" \(in (?P<module>[^)]+)\) failed')
+# @ERROR: Unknown module 'etc'. Остальные @ERROR(max connections, auth failed) - ошибка опроса
+UNKNOWN_MODULE = '@ERROR: Unknown module'
+
+
+def split_path(path):
+    """
+    Разделение пути модуля на модуль rsync демона и путь внутри него
+    """
+    parts = path.strip('/').split('/', 1)
+    if len(parts) == 1:
+        return parts[0], ''
+    return parts[0], parts[1].strip('/')
+
+
+class Discovery:
+    def __init__(self, logging, timeout=0):
+        self.timeout = timeout
+        self.logging = logging      # type: rb_log.Log
+
+    def source(self, host, path):
+        if host.user:
+            return 'rsync://{host.user}@{host.ip}:{host.port}{path}'.format(host=host, path=path)
+        return 'rsync://{host.ip}:{host.port}{path}'.format(host=host, path=path)
+
+    def probe(self, host, modules, host_logging):
+        """
+        Один не рекурсивный запрос всех путей модулей, размещённых в одном модуле rsync демона
+        :type host: rb_db.Host
+        :type host_logging: rb_log.Log
+        :return: список найденных модулей или None при ошибке опроса(активные модули сохраняются)
+        """
+        command = [RSYNC, '--list-only', '--dirs', '--no-motd', '--timeout=15']
+        if host.password:
+            command += ['--password-file', host.password]
+        command += [self.source(host, module.path) for module in modules]
+
+        # Ошибки stderr собираются отдельно: хвост вывода вытесняется строками списка каталогов stdout
+        errors = []
+
+        def error(text):
+            if '@ERROR' in text or ERROR_PATH.search(text):
+                errors.append(text)
+
+        host_logging.debug('run discovering: {cmd}'.format(cmd=' '.join(command)))
+        run = rb_runner.Runner(command, timeout=self.timeout, tail=50 + 4 * len(modules), error=error)
+        try:
+            run.run()
+        except OSError:
+            host_logging.error('Хост: {host.name} - error subprocess.Popen'.format(host=host))
+            return None
+
+        stderr = '\n'.join(errors)
+        if run.timed_out:
+            host_logging.warning('Хост: {host.name} - превышено время обнаружения модулей'.format(host=host))
+            return None
+        if run.returncode in (0, 23, 24):
+            missing = set()
+            for match in ERROR_PATH.finditer(stderr):
+                missing.add((match.group('module'), match.group('path').strip('/')))
+            return [module for module in modules if split_path(module.path) not in missing]
+        elif UNKNOWN_MODULE in stderr:
+            # Модуль rsync демона отсутствует
+            return []
+
+        host_logging.warning('Хост: {host.name} - ошибка обнаружения модулей\n{res}'.format(host=host,
+                                                                                           res=run.output()))
+        return None
+
+    def modules(self, host, modules, host_logging):
+        """
+        Поиск модулей на хосте, по одному сеансу rsync на каждый модуль rsync демона
+        :type host: rb_db.Host
+        :type host_logging: rb_log.Log
+        """
+        groups = {}
+        for module in modules:
+            groups.setdefault(split_path(module.path)[0], []).append(module)
+
+        found = []
+        for name in sorted(groups):
+            result = self.probe(host, groups[name], host_logging)
+            if result is None:
+                return None
+            found += result
+        return found
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    Filename : history
+    Date: 17.10.2026 17:00
+    Project: pyRsyncBackup
+    AUTHOR : Sergey Utkin
+
+    Copyright 2019 Sergey Utkin utkins01@gmail.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import datetime
+
+import sqlalchemy
+
+import database as rb_db
+
+Run = rb_db.BackupRun
+
+
+def record(active_module, module, start, run, tunnel_time=None, drift=None):
+    """
+    Запись истории по результату запуска rsync
+    :type active_module: rb_db.ActiveModules
+    :type module: rb_db.Module
+    :type start: datetime.datetime
+    :type run: runner.Runner
+    :param drift: количество файлов, изменения которых найдены только проверкой контрольных сумм
+    :return: dict для bulk_insert_mappings
+    """
+    values = {
+        'host': active_module.host,
+        'module': active_module.module,
+        'mode': module.mode,
+        'start_date': start,
+        'duration': run.duration,
+        'tunnel_time': tunnel_time,
+        'returncode': run.returncode,
+        'timed_out': run.timed_out,
+        'success': run.returncode == 0 and not run.timed_out,
+        'verify': drift is not None,
+        'drift': drift,
+    }
+    values.update(run.stats)
+    return values
+
+
+def _filter(query, since, host=None, module=None):
+    query = query.filter(Run.start_date >= datetime.datetime.now() - datetime.timedelta(seconds=since))
+    if host is not None:
+        query = query.filter(Run.host == host)
+    if module is not None:
+        query = query.filter(Run.module == module)
+    return query
+
+
+def throughput(session, since, host=None, module=None):
+    """
+    Скорость передачи по дням
+    :return: [(день, запусков, передано байт, длительность, байт/с)]
+    """
+    day = sqlalchemy.func.date(Run.start_date)
+    query = session.query(day,
+                          sqlalchemy.func.count(Run.id),
+                          sqlalchemy.func.sum(Run.bytes_received),
+                          sqlalchemy.func.sum(Run.duration))
+    query = _filter(query, since, host, module).filter(Run.success == True, Run.verify == False)
+    result = []
+    for date, count, received, duration in query.group_by(day).order_by(day).all():
+        received = int(received or 0)
+        duration = float(duration or 0)
+        result.append((date, count, received, duration, received / duration if duration else 0))
+    return result
+
+
+def slowest(session, since, limit=10, host=None):
+    """
+    Модули с наибольшим средним временем копирования
+    :return: [(хост, модуль, запусков, средняя длительность, максимальная длительность)]
+    """
+    average = sqlalchemy.func.avg(Run.duration)
+    query = session.query(rb_db.Host.name, Run.module,
+                          sqlalchemy.func.count(Run.id), average, sqlalchemy.func.max(Run.duration)
+                          ).join(rb_db.Host, rb_db.Host.id == Run.host)
+    query = _filter(query, since, host)
+    return query.group_by(rb_db.Host.name, Run.module).order_by(average.desc()).limit(limit).all()
+
+
+def failures(session, since, host=None):
+    """
+    Доля неудачных запусков по модулям
+    :return: [(хост, модуль, запусков, неудачных, доля неудачных)]
+    """
+    failed = sqlalchemy.func.sum(sqlalchemy.case([(Run.success == False, 1)], else_=0))
+    total = sqlalchemy.func.count(Run.id)
+    query = session.query(rb_db.Host.name, Run.module, total, failed).join(rb_db.Host, rb_db.Host.id == Run.host)
+    query = _filter(query, since, host)
+    result = []
+    for name, module, count, fail in query.group_by(rb_db.Host.name, Run.module).all():
+        fail = int(fail or 0)
+        result.append((name, module, count, fail, float(fail) / count if count else 0))
+    result.sort(key=lambda item: item[4], reverse=True)
+    return result
+
+
+def drift(session, since, host=None):
+    """
+    Результаты проверки контрольными суммами
+    :return: [(хост, модуль, проверок, файлов с расхождениями, дата последней проверки)]
+    """
+    query = session.query(rb_db.Host.name, Run.module, sqlalchemy.func.count(Run.id),
+                          sqlalchemy.func.sum(Run.drift), sqlalchemy.func.max(Run.start_date)
+                          ).join(rb_db.Host, rb_db.Host.id == Run.host).filter(Run.verify == True)
+    query = _filter(query, since, host)
+    return query.group_by(rb_db.Host.name, Run.module).order_by(sqlalchemy.func.sum(Run.drift).desc()).all()
+
+
+def dedup(session, since, host=None):
+    """
+    Результаты дедупликации по хостам
+    :return: [(хост, запусков, файлов, жёстких ссылок, reflink, освобождено байт)]
+    """
+    Dedup = rb_db.DedupRun
+    query = session.query(rb_db.Host.name, sqlalchemy.func.count(Dedup.id), sqlalchemy.func.sum(Dedup.files),
+                          sqlalchemy.func.sum(Dedup.linked), sqlalchemy.func.sum(Dedup.reflinked),
+                          sqlalchemy.func.sum(Dedup.saved)
+                          ).join(rb_db.Host, rb_db.Host.id == Dedup.host).filter(
+        Dedup.start_date >= datetime.datetime.now() - datetime.timedelta(seconds=since))
+    if host is not None:
+        query = query.filter(Dedup.host == host)
+    return query.group_by(rb_db.Host.name).order_by(sqlalchemy.func.sum(Dedup.saved).desc()).all()
+
+
+def last_success(session):
+    """
+    Время последнего успешного запуска по хостам
+    :return: [(хост, дата)]
+    """
+    return session.query(rb_db.Host.name, sqlalchemy.func.max(Run.start_date)).join(
+        rb_db.Host, rb_db.Host.id == Run.host).filter(Run.success == True).group_by(rb_db.Host.name).all()
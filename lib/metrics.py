@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    Filename : metrics
+    Date: 17.10.2026 18:00
+    Project: pyRsyncBackup
+    AUTHOR : Sergey Utkin
+
+    Copyright 2019 Sergey Utkin utkins01@gmail.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+PREFIX = 'pyrsyncbackup_'
+
+PROBE = 'probe'
+TUNNEL = 'tunnel'
+DISCOVERY = 'discovery'
+RSYNC = 'rsync'
+DB = 'db'
+DEDUP = 'dedup'
+REPLICA = 'replica'
+
+BUCKETS = [0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600, 7200, 14400]
+
+
+class Phases:
+    """
+    Длительность этапов задания в процессе пула, передаётся основному процессу в результате задания
+    """
+    def __init__(self):
+        self.items = []
+
+    @contextmanager
+    def __call__(self, phase):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.items.append((phase, time.time() - start))
+
+    def add(self, phase, seconds):
+        self.items.append((phase, seconds))
+
+    def result(self, success, received=0, saved=0):
+        return {'phases': self.items, 'success': success, 'bytes': received, 'saved': saved}
+
+
+def labels(values):
+    if not values:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for key, value in sorted(values.items())) + '}'
+
+
+class Metrics:
+    """
+    Метрики планировщика в формате Prometheus, обновляются только основным процессом
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.gauges = {}
+        self.histograms = {}
+        self.bytes = {}
+        self.saved = {}
+        self.jobs = {}
+        self.last_success = {}
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe(self, phase, seconds):
+        with self.lock:
+            counts, total = self.histograms.get(phase, ([0] * (len(BUCKETS) + 1), 0.0))
+            counts[bisect_left(BUCKETS, seconds)] += 1
+            self.histograms[phase] = (counts, total + seconds)
+
+    def success(self, host, job, timestamp):
+        with self.lock:
+            self.last_success[(host, job)] = timestamp
+
+    def job(self, host, job, result):
+        """
+        Учёт результата задания
+        :param result: Phases.result() или другое значение для заданий без метрик
+        """
+        if not isinstance(result, dict):
+            success = result is not False
+            phases = []
+            received = 0
+            saved = 0
+        else:
+            success = result['success']
+            phases = result['phases']
+            received = result['bytes']
+            saved = result.get('saved', 0)
+        for phase, seconds in phases:
+            self.observe(phase, seconds)
+        with self.lock:
+            key = (host, job, 'success' if success else 'failure')
+            self.jobs[key] = self.jobs.get(key, 0) + 1
+            if received:
+                self.bytes[host] = self.bytes.get(host, 0) + received
+            if saved:
+                self.saved[host] = self.saved.get(host, 0) + saved
+        if success:
+            self.success(host, job, time.time())
+
+    def scheduler(self, scheduler, now):
+        """
+        Состояние очереди планировщика
+        :type scheduler: scheduler.Scheduler
+        """
+        due = len([item for item in scheduler.ready if item[2] not in scheduler.running])
+        due += len([item for item in scheduler.queue if item[0] <= now])
+        self.gauge('queue_depth', len(scheduler.queue) + len(scheduler.ready))
+        self.gauge('due_jobs', due)
+        self.gauge('active_workers', len(scheduler.running))
+        self.gauge('workers', scheduler.threads)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name in sorted(self.gauges):
+                lines.append('# TYPE {0}{1} gauge'.format(PREFIX, name))
+                lines.append('{0}{1} {2}'.format(PREFIX, name, self.gauges[name]))
+
+            lines.append('# TYPE {0}phase_duration_seconds histogram'.format(PREFIX))
+            for phase in sorted(self.histograms):
+                counts, total = self.histograms[phase]
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ['+Inf'], counts):
+                    cumulative += count
+                    lines.append('{0}phase_duration_seconds_bucket{1} {2}'.format(
+                        PREFIX, labels({'phase': phase, 'le': bound}), cumulative))
+                lines.append('{0}phase_duration_seconds_sum{1} {2}'.format(PREFIX, labels({'phase': phase}), total))
+                lines.append('{0}phase_duration_seconds_count{1} {2}'.format(
+                    PREFIX, labels({'phase': phase}), cumulative))
+
+            lines.append('# TYPE {0}jobs_total counter'.format(PREFIX))
+            for (host, job, status), count in sorted(self.jobs.items()):
+                lines.append('{0}jobs_total{1} {2}'.format(
+                    PREFIX, labels({'host': host, 'job': job, 'status': status}), count))
+
+            lines.append('# TYPE {0}received_bytes_total counter'.format(PREFIX))
+            for host, count in sorted(self.bytes.items()):
+                lines.append('{0}received_bytes_total{1} {2}'.format(PREFIX, labels({'host': host}), count))
+
+            lines.append('# TYPE {0}dedup_saved_bytes_total counter'.format(PREFIX))
+            for host, count in sorted(self.saved.items()):
+                lines.append('{0}dedup_saved_bytes_total{1} {2}'.format(PREFIX, labels({'host': host}), count))
+
+            lines.append('# TYPE {0}last_success_timestamp_seconds gauge'.format(PREFIX))
+            for (host, job), timestamp in sorted(self.last_success.items()):
+                lines.append('{0}last_success_timestamp_seconds{1} {2:.0f}'.format(
+                    PREFIX, labels({'host': host, 'job': job}), timestamp))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """
+        Атомарная запись для textfile collector node_exporter
+        """
+        tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.rename(tmp, path)
+
+    def serve(self, address, port):
+        """
+        HTTP сервер /metrics в отдельном потоке
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer((address, port), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
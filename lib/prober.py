@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    Filename : prober
+    Date: 17.10.2026 16:00
+    Project: pyRsyncBackup
+    AUTHOR : Sergey Utkin
+
+    Copyright 2019 Sergey Utkin utkins01@gmail.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import errno
+import select
+import socket
+import time
+
+
+class Prober:
+    """
+    Одновременная проверка доступности TCP портов неблокирующими соединениями.
+    Результат хранится ttl секунд.
+    """
+    def __init__(self, timeout=3, ttl=60):
+        self.timeout = timeout
+        self.ttl = ttl
+        self.cache = {}
+
+    def cached(self, address):
+        item = self.cache.get(address)
+        if item and item[0] > time.time():
+            return item[1]
+        return None
+
+    def probe(self, addresses):
+        """
+        :param addresses: [(ip, port)]
+        :return: {(ip, port): доступен}
+        """
+        result = {}
+        sockets = {}
+        poller = select.poll()
+
+        for address in set(addresses):
+            if self.cached(address) is not None:
+                result[address] = self.cached(address)
+                continue
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(0)
+            try:
+                code = sock.connect_ex((address[0], int(address[1])))
+            except socket.error:
+                code = errno.EHOSTUNREACH
+            if code == 0:
+                result[address] = True
+                sock.close()
+            elif code in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                sockets[sock.fileno()] = (sock, address)
+                poller.register(sock, select.POLLOUT | select.POLLERR | select.POLLHUP)
+            else:
+                result[address] = False
+                sock.close()
+
+        deadline = time.time() + self.timeout
+        while sockets and time.time() < deadline:
+            for fd, event in poller.poll(max(deadline - time.time(), 0) * 1000):
+                sock, address = sockets.pop(fd)
+                poller.unregister(fd)
+                result[address] = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0
+                sock.close()
+
+        # Не ответившие за timeout считаются недоступными
+        for sock, address in sockets.values():
+            result[address] = False
+            sock.close()
+
+        for address, alive in result.items():
+            if address not in self.cache or self.cache[address][0] <= time.time():
+                self.cache[address] = (time.time() + self.ttl, alive)
+        return result
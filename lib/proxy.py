@@ -22,43 +22,316 @@
    limitations under the License.
 """
 
+import multiprocessing
+import select
+import socket
+import threading
+import time
+
+import paramiko
+
 import database as rb_db
 import log as rb_log
 import error as rb_error
-import sshtunnel
 
+# Сообщения между основным процессом и процессом перенаправления
+FORWARD = 'forward'
+READY = 'ready'
+FAILED = 'failed'
+CLOSED = 'closed'
+STOP = 'stop'
 
-class Proxy:
-    def __init__(self, proxy, host, logging):
-        self.proxy = proxy          # type: rb_db.Proxy
-        self.logging = logging      # type: rb_log.Log
-        self.host = host            # type: rb_db.Host
 
-        self.client = sshtunnel.SSHTunnelForwarder(
-            (self.proxy.ip,self.proxy.port),
-            ssh_username=self.proxy.login,
-            ssh_password=self.proxy.password,
-            remote_bind_address=(self.host.ip, self.host.port),
-            local_bind_address=('127.0.0.1',),
-            logger=logging.logger
-        )
+def pump(sock, channel):
+    """
+    Передача данных между локальным соединением и ssh каналом
+    """
+    try:
+        while True:
+            r, w, x = select.select([sock, channel], [], [], 60)
+            if sock in r:
+                data = sock.recv(32768)
+                if not data:
+                    break
+                channel.sendall(data)
+            if channel in r:
+                data = channel.recv(32768)
+                if not data:
+                    break
+                sock.sendall(data)
+    except (socket.error, EOFError, paramiko.SSHException):
+        pass
+    finally:
+        channel.close()
+        sock.close()
 
-    def start(self):
+
+class Forward:
+    """
+    Локальный порт, перенаправляемый через ssh транспорт прокси сервера на порт хоста
+    """
+    def __init__(self, manager, proxy_id, remote):
+        self.manager = manager      # type: TunnelManager
+        self.proxy_id = proxy_id
+        self.remote = remote
+        self.active = 0
+        self.last_used = time.time()
+        self.closed = False
+        self.lock = threading.Lock()
+
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(16)
+        self.address = self.server.getsockname()
+
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        while not self.closed:
+            r, w, x = select.select([self.server], [], [], 1)
+            if not r or self.closed:
+                continue
+            try:
+                sock, peer = self.server.accept()
+            except socket.error:
+                continue
+            self.last_used = time.time()
+            try:
+                channel = self.manager.transport(self.proxy_id).open_channel('direct-tcpip', self.remote, peer)
+            except (paramiko.SSHException, rb_error.RBError, socket.error) as err:
+                self.manager.logging.warning('Прокси {0} - ошибка открытия канала {1}: {2}'.format(
+                    self.proxy_id, self.remote, err))
+                sock.close()
+                continue
+            thread = threading.Thread(target=self.connection, args=(sock, channel))
+            thread.daemon = True
+            thread.start()
+
+    def connection(self, sock, channel):
+        with self.lock:
+            self.active += 1
         try:
-            self.client.start()
-        except sshtunnel.HandlerSSHTunnelForwarderError:
-            rb_error.RBError('Ошибка подключения к прокси серверу - {proxy.ip}'.format(proxy=self.proxy))
-        except sshtunnel.BaseSSHTunnelForwarderError:
-            rb_error.RBError('Ошибка подключения к прокси серверу - {proxy.ip}'.format(proxy=self.proxy))
+            pump(sock, channel)
+        finally:
+            with self.lock:
+                self.active -= 1
+            self.last_used = time.time()
+
+    def idle(self):
+        return time.time() - self.last_used if self.active == 0 else 0
+
+    def stop(self):
+        self.closed = True
+        self.server.close()
+
+
+class TunnelManager:
+    """
+    Один ssh транспорт на прокси сервер, локальные порты для хостов открываются по требованию
+    и переиспользуются всеми модулями и типами заданий.
+    """
+    def __init__(self, logging, keepalive=30, idle_timeout=300):
+        self.logging = logging      # type: rb_log.Log
+        self.keepalive = keepalive
+        self.idle_timeout = idle_timeout
+        self.proxies = {}
+        self.clients = {}
+        self.forwards = {}
+        self.lock = threading.Lock()
+        # Подключение к медленному прокси серверу не задерживает каналы остальных прокси
+        self.locks = {}
+
+    def load(self, proxies):
+        for proxy in proxies:           # type: rb_db.Proxy
+            self.proxies[proxy.id] = proxy
+            self.locks.setdefault(proxy.id, threading.Lock())
 
-    def get_port_forward_info(self):
-        return self.client.local_bind_address
+    def transport(self, proxy_id):
+        with self.locks[proxy_id]:
+            client = self.clients.get(proxy_id)
+            if client and client.get_transport() and client.get_transport().is_active():
+                return client.get_transport()
 
-    def is_active(self):
-        return self.client.is_active
+            proxy = self.proxies[proxy_id]
+            client = paramiko.SSHClient()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            try:
+                client.connect(proxy.ip, port=int(proxy.port), username=proxy.login, password=proxy.password,
+                               timeout=10)
+            except (paramiko.SSHException, socket.error) as err:
+                raise rb_error.RBError('Ошибка подключения к прокси серверу - {proxy.ip}: {err}'.format(
+                    proxy=proxy, err=err))
+            client.get_transport().set_keepalive(self.keepalive)
+            self.clients[proxy_id] = client
+            self.logging.debug('Прокси {proxy.ip} - ssh транспорт установлен.'.format(proxy=proxy))
+            return client.get_transport()
+
+    def forward(self, proxy_id, ip, port):
+        """
+        Локальный адрес, перенаправляемый на ip:port через прокси сервер
+        :return: (ip, port)
+        """
+        key = (proxy_id, ip, int(port))
+        self.transport(proxy_id)
+        with self.lock:
+            if key not in self.forwards or self.forwards[key].closed:
+                self.forwards[key] = Forward(self, proxy_id, (ip, int(port)))
+            self.forwards[key].last_used = time.time()
+            return self.forwards[key].address
+
+    def cleanup(self):
+        """
+        Закрытие неиспользуемых перенаправлений и транспортов
+        :return: ключи закрытых перенаправлений
+        """
+        closed = []
+        with self.lock:
+            for key in list(self.forwards):
+                if self.forwards[key].idle() > self.idle_timeout:
+                    self.forwards.pop(key).stop()
+                    closed.append(key)
+            used = set(key[0] for key in self.forwards)
+        for proxy_id in list(self.clients):
+            if proxy_id not in used:
+                with self.locks[proxy_id]:
+                    client = self.clients.pop(proxy_id, None)
+                if client:
+                    client.close()
+                    self.logging.debug('Прокси {proxy.ip} - ssh транспорт закрыт.'.format(
+                        proxy=self.proxies[proxy_id]))
+        return closed
 
     def stop(self):
-        self.client.stop()
+        with self.lock:
+            for forward in self.forwards.values():
+                forward.stop()
+            self.forwards = {}
+        for proxy_id in list(self.clients):
+            self.clients.pop(proxy_id).close()
 
-    def __del__(self):
-        pass
+    def serve(self, conn):
+        """
+        Цикл процесса перенаправления: перенаправления открываются по запросам основного процесса
+        в отдельных потоках, неиспользуемые закрываются с уведомлением основного процесса
+        :type conn: multiprocessing.Connection
+        """
+        lock = threading.Lock()
+
+        def send(message):
+            with lock:
+                try:
+                    conn.send(message)
+                except (IOError, OSError):
+                    pass
+
+        def open_forward(key):
+            try:
+                send((READY, key, self.forward(*key)))
+            except (rb_error.RBError, paramiko.SSHException, socket.error) as err:
+                send((FAILED, key, str(err)))
+
+        while True:
+            try:
+                if conn.poll(1):
+                    message = conn.recv()
+                    if message[0] == STOP:
+                        break
+                    thread = threading.Thread(target=open_forward, args=(message[1],))
+                    thread.daemon = True
+                    thread.start()
+            except (EOFError, IOError, OSError):
+                break
+            for key in self.cleanup():
+                send((CLOSED, key, None))
+        self.stop()
+
+
+class Forwarder:
+    """
+    Процесс перенаправления портов. ssh транспорты, подключение к прокси серверам и копирование данных
+    туннелей выполняются вне процесса планировщика. Основной процесс не ожидает подключения:
+    адрес возвращается, когда перенаправление уже открыто, до этого задание откладывается.
+    """
+    def __init__(self, logging, keepalive=30, idle_timeout=300):
+        self.logging = logging      # type: rb_log.Log
+        self.manager = TunnelManager(logging, keepalive, idle_timeout)
+        self.proxies = self.manager.proxies
+        self.ready = {}             # ключ: локальный адрес
+        self.pending = {}           # ключ: время запроса
+        self.failed = {}            # ключ: текст ошибки
+        self.times = {}             # ключ: время формирования перенаправления
+        self.conn = None
+        self.process = None
+
+    def load(self, proxies):
+        self.manager.load(proxies)
+
+    def start(self):
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=self.manager.serve, args=(child,))
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+        self.ready, self.pending, self.failed, self.times = {}, {}, {}, {}
+
+    def poll(self):
+        """
+        Обработка ответов процесса перенаправления, перезапуск завершившегося процесса
+        """
+        if self.process is None:
+            return
+        try:
+            while self.conn.poll():
+                kind, key, value = self.conn.recv()
+                requested = self.pending.pop(key, None)
+                if kind == READY:
+                    if key not in self.ready and requested is not None:
+                        self.times[key] = time.time() - requested
+                    self.ready[key] = value
+                elif kind == FAILED:
+                    self.ready.pop(key, None)
+                    self.failed[key] = value
+                elif kind == CLOSED:
+                    self.ready.pop(key, None)
+        except (EOFError, IOError, OSError):
+            pass
+        if not self.process.is_alive():
+            self.logging.error('Процесс перенаправления портов завершился({code}), перезапуск.'.format(
+                code=self.process.exitcode))
+            self.start()
+
+    def forward(self, proxy_id, ip, port):
+        """
+        Адрес открытого перенаправления на ip:port через прокси сервер
+        :return: ((ip, port), время формирования при первом использовании) или (None, None), пока открывается
+        """
+        key = (proxy_id, ip, int(port))
+        self.poll()
+        if key in self.failed:
+            raise rb_error.RBError(self.failed.pop(key))
+        # Повторный запрос открытого перенаправления продлевает его использование
+        if key not in self.pending:
+            self.pending[key] = time.time()
+            try:
+                self.conn.send((FORWARD, key))
+            except (IOError, OSError):
+                self.pending.pop(key)
+        if key in self.ready:
+            return self.ready[key], self.times.pop(key, 0)
+        return None, None
+
+    def stop(self):
+        if self.process is None:
+            return
+        if self.process.is_alive():
+            try:
+                self.conn.send((STOP, None))
+            except (IOError, OSError):
+                pass
+            self.process.join(15)
+            if self.process.is_alive():
+                self.process.terminate()
+        self.process = None
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    Filename : replica
+    Date: 18.10.2026 01:00
+    Project: pyRsyncBackup
+    AUTHOR : Sergey Utkin
+
+    Copyright 2019 Sergey Utkin utkins01@gmail.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import datetime
+import os
+
+import database as rb_db
+import log as rb_log
+import runner as rb_runner
+import snapshot as rb_snapshot
+
+Queue = rb_db.ReplicaQueue
+
+
+def batch_path(batch_dir, host, module, timestamp):
+    """
+    Файл пакета rsync --write-batch запуска модуля
+    """
+    return os.path.join(batch_dir, '{host}.{module}.{timestamp}'.format(host=host.name, module=module.name,
+                                                                       timestamp=timestamp))
+
+
+def remove_batch(path):
+    """
+    Удаление пакета и сценария .sh, который rsync создаёт рядом с ним
+    """
+    if not path:
+        return
+    for name in [path, path + '.sh']:
+        try:
+            os.unlink(name)
+        except OSError:
+            pass
+
+
+def partial(directory):
+    """
+    В каталоге есть незавершённый снимок, который следующий запуск использует повторно
+    """
+    return os.path.isdir(directory) and any(name.endswith(rb_snapshot.PARTIAL) for name in os.listdir(directory))
+
+
+def enqueue(engine, host_id, module, timestamp, batch, base):
+    """
+    Постановка пакета в очередь реплики
+    :param batch: файл пакета, None - реплика отстала и требуется полная синхронизация
+    :param base: каталог, относительно которого записан пакет(current или --link-dest снимок), None - пустой
+    """
+    with rb_db.edit(engine) as dbe:
+        dbe.add(Queue(host=host_id, module=module, timestamp=timestamp, batch=batch, base=base,
+                      create_date=datetime.datetime.now()))
+        dbe.query(rb_db.Host).filter(rb_db.Host.id == host_id).update(
+            {rb_db.Host.replica_date: datetime.datetime.now()})
+
+
+def pending(session, host_id):
+    """
+    Очередь реплик хоста по модулям в порядке записи пакетов
+    :return: {модуль: [ReplicaQueue]}
+    """
+    result = {}
+    for entry in session.query(Queue).filter(Queue.host == host_id).order_by(Queue.id).all():
+        result.setdefault(entry.module, []).append(entry)
+    return result
+
+
+class Replica:
+    """
+    Реплика модуля на втором хранилище. Основной запуск записывает пакет rsync --write-batch,
+    задание реплики воспроизводит пакеты по порядку(--read-batch), источник читается один раз.
+    Пакет применим, только если реплика совпадает с основной копией до запуска, поэтому после ошибки
+    реплика выравнивается полной локальной синхронизацией основной копии.
+    """
+    def __init__(self, engine, logging, timeout=0):
+        self.engine = engine
+        self.logging = logging      # type: rb_log.Log
+        self.timeout = timeout
+
+    def _run(self, command):
+        run = rb_runner.Runner(command, timeout=self.timeout)
+        try:
+            run.run()
+        except OSError:
+            self.logging.error('Replica: error subprocess.Popen {0}'.format(command[0]))
+            return False
+        if run.returncode != 0 or run.timed_out:
+            self.logging.warning('Replica: ошибка {command}\n{res}'.format(command=' '.join(command),
+                                                                         res=run.output()))
+            return False
+        return True
+
+    def replay(self, directory, module, entry):
+        """
+        Воспроизведение одного пакета
+        :type module: rb_db.Module
+        :type entry: rb_db.ReplicaQueue
+        """
+        if not os.path.isfile(entry.batch):
+            return False
+        if entry.base and not os.path.isdir(os.path.join(directory, entry.base)):
+            return False
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        command = ['/usr/bin/rsync', '-alk', '--delete', '--read-batch={0}'.format(entry.batch)]
+        if module.mode == rb_snapshot.SNAPSHOT:
+            if partial(directory):
+                return False
+            target = rb_snapshot.prepare(directory, entry.timestamp)
+            if entry.base:
+                command.append('--link-dest={0}'.format(os.path.join(directory, entry.base)))
+        else:
+            target = os.path.join(directory, rb_snapshot.CURRENT)
+            command += ['--backup', '--backup-dir', os.path.join(directory, entry.timestamp)]
+
+        if not self._run(command + [target]):
+            return False
+        if module.mode == rb_snapshot.SNAPSHOT:
+            rb_snapshot.commit(directory, entry.timestamp)
+        elif os.path.isdir(os.path.join(directory, entry.timestamp)) and \
+                not os.listdir(os.path.join(directory, entry.timestamp)):
+            os.rmdir(os.path.join(directory, entry.timestamp))
+        return True
+
+    def sync(self, source, directory):
+        """
+        Полная синхронизация реплики с основной копией, жёсткие ссылки снимков сохраняются
+        """
+        if not os.path.isdir(source):
+            return True
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        return self._run(['/usr/bin/rsync', '-aH', '--delete', source + '/', directory + '/'])
+
+    def module(self, host, module, entries):
+        """
+        Применение очереди модуля
+        :type host: rb_db.Host
+        :type module: rb_db.Module
+        :return: (успешность, применено пакетов, выполнена полная синхронизация)
+        """
+        source = os.path.join(host.backup_directory, host.name, module.name)
+        directory = os.path.join(module.replica, host.name, module.name)
+
+        full = any(entry.batch is None for entry in entries)
+        applied = 0
+        if not full:
+            for entry in entries:
+                if not self.replay(directory, module, entry):
+                    self.logging.warning('Replica: {host.name} {module.name} - пакет {timestamp} не применён, '
+                                         'полная синхронизация'.format(host=host, module=module,
+                                                                       timestamp=entry.timestamp))
+                    full = True
+                    break
+                applied += 1
+        success = self.sync(source, directory) if full else True
+
+        # Полная синхронизация включает все пакеты очереди, после ошибки остаётся одна запись полной синхронизации
+        with rb_db.edit(self.engine) as dbe:
+            done = entries if full else entries[:applied]
+            dbe.query(Queue).filter(Queue.id.in_([entry.id for entry in done])).delete(synchronize_session=False)
+            if not success:
+                dbe.add(Queue(host=host.id, module=module.name, timestamp=entries[-1].timestamp, batch=None,
+                              base=None, create_date=datetime.datetime.now()))
+        for entry in done:
+            remove_batch(entry.batch)
+        return success, applied, full and success
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    Filename : resources
+    Date: 17.10.2026 12:00
+    Project: pyRsyncBackup
+    AUTHOR : Sergey Utkin
+
+    Copyright 2019 Sergey Utkin utkins01@gmail.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import os
+
+import scheduler as rb_scheduler
+
+DESTINATION = 'destination'
+PROXY = 'proxy'
+VERIFY = 'verify'
+DEDUP = 'dedup'
+REPLICA = 'replica'
+
+
+def mount_point(path):
+    """
+    Точка монтирования файловой системы, на которой расположен путь
+    """
+    path = os.path.realpath(path)
+    while not os.path.ismount(path):
+        path = os.path.dirname(path)
+    return path
+
+
+class Resources:
+    def __init__(self, limits):
+        self.limits = limits        # type: dict   тип ресурса -> количество слотов, 0 - без ограничений
+        self.used = {}
+        self.mounts = {}
+
+    def keys(self, host, job):
+        """
+        Именованные ресурсы, необходимые заданию
+        :type host: rb_db.Host
+        """
+        keys = []
+        if host.proxy and self.limits.get(PROXY):
+            keys.append((PROXY, host.proxy))
+        if job == rb_scheduler.VERIFY and self.limits.get(VERIFY):
+            keys.append((VERIFY, None))
+        # Индекс дедупликации общий для всех хостов
+        if job == rb_scheduler.DEDUP and self.limits.get(DEDUP):
+            keys.append((DEDUP, None))
+        if job == rb_scheduler.REPLICA and self.limits.get(REPLICA):
+            keys.append((REPLICA, None))
+        if job in (rb_scheduler.BACKUP, rb_scheduler.VERIFY) and host.backup_directory and \
+                self.limits.get(DESTINATION):
+            if host.backup_directory not in self.mounts:
+                self.mounts[host.backup_directory] = mount_point(host.backup_directory)
+            keys.append((DESTINATION, self.mounts[host.backup_directory]))
+        return keys
+
+    def acquire(self, keys):
+        for key in keys:
+            if self.used.get(key, 0) >= self.limits[key[0]]:
+                return False
+        for key in keys:
+            self.used[key] = self.used.get(key, 0) + 1
+        return True
+
+    def release(self, keys):
+        for key in keys:
+            self.used[key] -= 1
+            if self.used[key] <= 0:
+                del self.used[key]
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    Filename : restore
+    Date: 18.10.2026 00:00
+    Project: pyRsyncBackup
+    AUTHOR : Sergey Utkin
+
+    Copyright 2019 Sergey Utkin utkins01@gmail.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import heapq
+import os
+import sys
+
+import error as rb_error
+import snapshot as rb_snapshot
+
+
+def sources(module_dir, mode, date=None):
+    """
+    Каталоги, из которых собирается состояние модуля на дату
+    :param date: None - последнее состояние
+    :return: [каталог] в порядке приоритета, версия файла берётся из первого каталога, где она есть
+    """
+    backups = rb_snapshot.listing(module_dir)
+    if mode == rb_snapshot.SNAPSHOT:
+        names = [name for backup_date, name in backups if date is None or backup_date <= date]
+        if not names:
+            raise rb_error.RBError('Нет снимка {dir} на дату {date}'.format(dir=module_dir, date=date))
+        return [os.path.join(module_dir, names[-1])]
+
+    # Режим delta: каталог запуска содержит версии, заменённые или удалённые этим запуском.
+    # Для даты в прошлом версия файла берётся из самого раннего каталога после даты, иначе из current
+    current = os.path.join(module_dir, rb_snapshot.CURRENT)
+    if not os.path.isdir(current):
+        raise rb_error.RBError('Отсутствует каталог {dir}'.format(dir=current))
+    if date is None:
+        return [current]
+    return [os.path.join(module_dir, name) for backup_date, name in backups if backup_date > date] + [current]
+
+
+def plan(roots, path=None, absent=()):
+    """
+    Выбор каталога-источника для каждого файла
+    :param path: восстанавливаемый путь относительно каталога резервной копии
+    :param absent: пути, отсутствовавшие на дату(catalog.absent)
+    :return: ({путь: (каталог, размер)}, {путь каталога: каталог})
+    """
+    files = {}
+    dirs = {}
+    for root in roots:
+        base = os.path.join(root, path) if path else root
+        if os.path.islink(base) or os.path.isfile(base):
+            files.setdefault(os.path.relpath(base, root), (root, os.lstat(base).st_size))
+            continue
+        for top, dir_names, file_names in os.walk(base):
+            rel_top = os.path.relpath(top, root)
+            if rel_top != '.':
+                dirs.setdefault(rel_top, root)
+            for name in file_names + [d for d in dir_names if os.path.islink(os.path.join(top, d))]:
+                full = os.path.join(top, name)
+                try:
+                    size = os.lstat(full).st_size
+                except OSError:
+                    continue
+                files.setdefault(os.path.normpath(os.path.join(rel_top, name)), (root, size))
+
+    for rel in absent:
+        files.pop(rel, None)
+        dirs.pop(rel, None)
+    # Тип пути изменился: более ранняя версия - файл
+    for rel in [rel for rel in dirs if rel in files]:
+        del dirs[rel]
+    return files, dirs
+
+
+def split(files, streams):
+    """
+    Распределение файлов по потокам rsync с выравниванием объёма, крупные файлы распределяются первыми
+    :return: [{каталог: [пути]}]
+    """
+    heap = [(0, index) for index in range(max(1, streams))]
+    buckets = [{} for item in heap]
+    for rel, (root, size) in sorted(files.items(), key=lambda item: item[1][1], reverse=True):
+        total, index = heapq.heappop(heap)
+        buckets[index].setdefault(root, []).append(rel)
+        heapq.heappush(heap, (total + size, index))
+    return [bucket for bucket in buckets if bucket]
+
+
+def encode(path):
+    """
+    Путь для списка --files-from --from0, имена не в utf-8 сохраняются без изменений
+    """
+    if isinstance(path, bytes):
+        return path
+    return path.encode(sys.getfilesystemencoding(), 'surrogateescape')
+
+
+def write_list(f, paths):
+    for path in sorted(paths):
+        f.write(encode(path) + b'\0')
+    f.flush()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    Filename : retention
+    Date: 17.10.2026 15:00
+    Project: pyRsyncBackup
+    AUTHOR : Sergey Utkin
+
+    Copyright 2019 Sergey Utkin utkins01@gmail.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import datetime
+import os
+import shutil
+
+import config as rb_conf
+import snapshot as rb_snapshot
+
+BUCKETS = [
+    ('KeepHourly', '%Y-%m-%d-%H'),
+    ('KeepDaily', '%Y-%m-%d'),
+    ('KeepWeekly', None),
+    ('KeepMonthly', '%Y-%m'),
+]
+
+
+def bucket(date, fmt):
+    if fmt is None:
+        return '{0[0]}-{0[1]}'.format(date.isocalendar())
+    return date.strftime(fmt)
+
+
+def unique_size(path):
+    """
+    Объём, освобождаемый при удалении каталога(файлы без других жёстких ссылок)
+    """
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                st = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            if st.st_nlink == 1:
+                size += st.st_blocks * 512
+    return size
+
+
+def remove(path):
+    size = unique_size(path)
+    shutil.rmtree(path, ignore_errors=True)
+    return size
+
+
+def merge(source, target):
+    """
+    Перенос файлов удаляемого каталога изменений в следующий сохраняемый каталог.
+    Более старая версия файла заменяет более новую, восстановление на сохраняемые даты остаётся корректным.
+    """
+    for root, dirs, files in os.walk(source):
+        rel = os.path.relpath(root, source)
+        dst_root = os.path.normpath(os.path.join(target, rel))
+        if os.path.lexists(dst_root) and not os.path.isdir(dst_root):
+            os.remove(dst_root)
+        if not os.path.isdir(dst_root):
+            os.makedirs(dst_root)
+        for name in files + [d for d in dirs if os.path.islink(os.path.join(root, d))]:
+            dst = os.path.join(dst_root, name)
+            if os.path.isdir(dst) and not os.path.islink(dst):
+                shutil.rmtree(dst)
+            os.rename(os.path.join(root, name), dst)
+    shutil.rmtree(source, ignore_errors=True)
+
+
+class Policy:
+    def __init__(self):
+        self.keep = {}
+        self.max_age = 0
+        self.max_size = 0
+
+    def __repr__(self):
+        return "{0}".format(self.__dict__)
+
+    def load(self, v):
+        """
+        Загрузка параметров в формате KeepDaily=7, MaxAge=90d
+        """
+        if not v:
+            return self
+        for values in str(v).replace(" ", "").split(','):
+            key, val = values.split('=')
+            if key in [name for name, fmt in BUCKETS]:
+                self.keep[key] = int(val)
+            elif key == 'MaxAge':
+                self.max_age = rb_conf.calc_size(val)
+            elif key == 'MaxSize':
+                self.max_size = rb_conf.calc_size(val)
+        return self
+
+    def copy(self):
+        policy = Policy()
+        policy.keep = dict(self.keep)
+        policy.max_age = self.max_age
+        policy.max_size = self.max_size
+        return policy
+
+    def enabled(self):
+        return any(self.keep.values()) or self.max_age or self.max_size
+
+    def plan(self, module_dir, mode, now=None):
+        """
+        Список каталогов на удаление
+        :return: ([каталоги для удаления], [(каталог, каталог для слияния)])
+        """
+        if now is None:
+            now = datetime.datetime.now()
+        backups = rb_snapshot.listing(module_dir)
+        if not self.enabled() or not backups:
+            return [], []
+
+        protected = set()
+        if mode == rb_snapshot.SNAPSHOT and rb_snapshot.latest(module_dir):
+            protected.add(os.path.basename(rb_snapshot.latest(module_dir)))
+
+        # Прореживание: в каждом интервале сохраняется самая новая копия
+        keep = set(name for date, name in backups)
+        if any(self.keep.values()):
+            keep = set()
+            for key, fmt in BUCKETS:
+                count = self.keep.get(key, 0)
+                seen = []
+                for date, name in reversed(backups):
+                    if len(seen) >= count:
+                        break
+                    b = bucket(date, fmt)
+                    if b not in seen:
+                        seen.append(b)
+                        keep.add(name)
+
+        # Ограничение по возрасту и объёму удаляет самые старые копии целиком
+        expired = set()
+        if self.max_age:
+            limit = now - datetime.timedelta(seconds=self.max_age)
+            expired.update(name for date, name in backups if date < limit)
+        if self.max_size:
+            total = 0
+            for date, name in reversed(backups):
+                total += unique_size(os.path.join(module_dir, name))
+                if total > self.max_size:
+                    expired.add(name)
+
+        delete = []
+        merges = []
+        names = [name for date, name in backups]
+        for index, name in enumerate(names):
+            if name in protected or (name in keep and name not in expired):
+                continue
+            newer = [n for n in names[index + 1:] if n in keep and n not in expired]
+            if mode != rb_snapshot.SNAPSHOT and name not in expired and newer:
+                merges.append((os.path.join(module_dir, name), os.path.join(module_dir, newer[0])))
+            else:
+                delete.append(os.path.join(module_dir, name))
+        # Слияние от новых к старым, в итоге остаётся самая старая версия файла
+        merges.reverse()
+        return delete, merges
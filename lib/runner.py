@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    Filename : runner
+    Date: 17.10.2026 13:00
+    Project: pyRsyncBackup
+    AUTHOR : Sergey Utkin
+
+    Copyright 2019 Sergey Utkin utkins01@gmail.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import os
+import re
+import signal
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+
+#      1,234,567  45%    1.23MB/s    0:00:12 (xfr#3, to-chk=0/10)
+PROGRESS = re.compile(r'^\s*(?P<bytes>[\d,]+)\s+(?P<percent>\d+)%\s+(?P<rate>\S+/s)\s+\S+'
+                      r'(?:\s+\(xfr#(?P<files>\d+), \w+-chk=\d+/\d+\))?')
+
+STATS = {
+    'Number of files': 'files',
+    'Number of regular files transferred': 'files_transferred',
+    'Total file size': 'total_size',
+    'Total transferred file size': 'transferred_size',
+    'Literal data': 'literal_data',
+    'Matched data': 'matched_data',
+    'Total bytes sent': 'bytes_sent',
+    'Total bytes received': 'bytes_received',
+}
+# Отдельная группа процессов для завершения rsync вместе с дочерними процессами по таймауту.
+# preexec_fn небезопасен при одновременном запуске из нескольких потоков, в python 2 другого способа нет
+if sys.version_info[0] >= 3:
+    SESSION = {'start_new_session': True}
+else:
+    SESSION = {'preexec_fn': os.setsid}
+
+STATS_LINE = re.compile(r'^(?P<name>[A-Z][\w ]+): (?P<value>[\d,]+)')
+
+# >fc.t...... etc/hosts   (--itemize-changes: YXcstpoguax путь)
+ITEMIZE = re.compile(r'^(?P<update>[<>ch.])(?P<type>[fdLDS])(?P<flags>[.+?a-zA-Z]{9}) (?P<path>.+)$')
+# *deleting   etc/old.conf   (--delete)
+DELETING = re.compile(r'^\*deleting\s+(?P<path>.+)$')
+
+
+def to_int(value):
+    return int(value.replace(',', ''))
+
+
+def itemize(text):
+    """
+    Разбор строки --itemize-changes
+    :return: (тип обновления, тип файла, атрибуты, путь) или None, для удалённых файлов тип обновления '*'
+    """
+    match = ITEMIZE.match(text)
+    if not match:
+        match = DELETING.match(text)
+        if match:
+            path = match.group('path')
+            return '*', 'd' if path.endswith('/') else 'f', 'deleting', path
+        return None
+    return match.group('update'), match.group('type'), match.group('flags'), match.group('path')
+
+
+def drift(item):
+    """
+    Содержимое файла отличается при совпадающих размере и времени изменения:
+    изменение найдено только проверкой контрольных сумм(-c)
+    """
+    update, kind, flags, path = item
+    return update == '>' and kind == 'f' and flags[0] == 'c' and flags[1] == '.' and flags[2] == '.'
+
+
+def received(item):
+    """
+    Содержимое обычного файла получено от хоста
+    """
+    return item[0] == '>' and item[1] == 'f'
+
+
+class Runner:
+    """
+    Запуск процесса с построчным чтением stdout/stderr.
+    В памяти хранится только последние tail строк вывода, разбор статистики и прогресса rsync выполняется на лету.
+    """
+    def __init__(self, command, timeout=0, tail=50, progress=None, progress_interval=60, line=None, error=None):
+        self.command = command
+        self.timeout = timeout
+        self.tail = deque(maxlen=tail)
+        self.progress = progress                    # callback(dict)
+        self.progress_interval = progress_interval
+        self.line = line                            # callback(str) для строк stdout
+        self.error = error                          # callback(str) для строк stderr
+        self.stats = {}
+        self.current = {}
+        self.returncode = None
+        self.timed_out = False
+        self.duration = 0
+        self._reported = 0
+
+    def _parse(self, text):
+        match = PROGRESS.match(text)
+        if match:
+            self.current = {
+                'bytes': to_int(match.group('bytes')),
+                'percent': int(match.group('percent')),
+                'rate': match.group('rate'),
+                'files': int(match.group('files') or 0)
+            }
+            if self.progress and time.time() - self._reported >= self.progress_interval:
+                self._reported = time.time()
+                self.progress(self.current)
+            return
+
+        match = STATS_LINE.match(text)
+        if match and match.group('name') in STATS:
+            self.stats[STATS[match.group('name')]] = to_int(match.group('value'))
+            return
+
+        if self.line:
+            self.line(text)
+        self.tail.append(text)
+
+    def _stderr(self, text):
+        if self.error:
+            self.error(text)
+        self.tail.append(text)
+
+    def _read(self, stream, parse):
+        buf = b''
+        while True:
+            chunk = os.read(stream.fileno(), 4096)
+            if not chunk:
+                break
+            buf += chunk
+            # progress2 разделяет обновления символом \r
+            parts = re.split(b'[\r\n]', buf)
+            buf = parts.pop()
+            for part in parts:
+                text = part.decode('utf-8', 'replace')
+                if not text.strip():
+                    continue
+                if parse:
+                    self._parse(text)
+                else:
+                    self._stderr(text)
+        if buf.strip():
+            text = buf.decode('utf-8', 'replace')
+            if parse:
+                self._parse(text)
+            else:
+                self._stderr(text)
+        stream.close()
+
+    def run(self):
+        start = time.time()
+        process = subprocess.Popen(self.command,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE,
+                                   **SESSION)
+        readers = [
+            threading.Thread(target=self._read, args=(process.stdout, True)),
+            threading.Thread(target=self._read, args=(process.stderr, False))
+        ]
+        for reader in readers:
+            reader.daemon = True
+            reader.start()
+
+        while process.poll() is None:
+            if self.timeout and time.time() - start > self.timeout:
+                self.timed_out = True
+                try:
+                    os.killpg(process.pid, signal.SIGTERM)
+                    time.sleep(5)
+                    if process.poll() is None:
+                        os.killpg(process.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                process.wait()
+                break
+            time.sleep(0.5)
+
+        for reader in readers:
+            reader.join()
+
+        self.returncode = process.returncode
+        self.duration = time.time() - start
+        return self.returncode
+
+    def output(self):
+        return '\n'.join(self.tail)
@@ -0,0 +1,393 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    Filename : scheduler
+    Date: 17.10.2026 10:00
+    Project: pyRsyncBackup
+    AUTHOR : Sergey Utkin
+
+    Copyright 2019 Sergey Utkin utkins01@gmail.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import datetime
+import heapq
+import itertools
+import random
+import sys
+import threading
+import time
+import traceback
+import zlib
+
+import error as rb_error
+import log as rb_log
+import metrics as rb_metrics
+
+DISCOVERING = 'discovering'
+BACKUP = 'backup'
+RETENTION = 'retention'
+VERIFY = 'verify'
+DEDUP = 'dedup'
+REPLICA = 'replica'
+
+# Задания с каталогом резервных копий, доступность хоста и туннель не требуются
+LOCAL = (RETENTION, DEDUP, REPLICA)
+
+# multiprocessing.Pool.apply_async(error_callback) - только python 3
+ERROR_CALLBACK = sys.version_info[0] >= 3
+
+# Интервал повторной попытки запуска, пока открывается перенаправление порта через прокси сервер, секунды
+TUNNEL_WAIT = 2
+
+
+def due_date(host, job):
+    """
+    Дата следующего запуска задания по данным хоста
+    :type host: rb_db.Host
+    """
+    return getattr(host, DATE_COLUMNS[job])
+
+
+DATE_COLUMNS = {
+    DISCOVERING: 'discovering_date',
+    BACKUP: 'backup_date',
+    RETENTION: 'retention_date',
+    VERIFY: 'verify_date',
+    DEDUP: 'dedup_date',
+    REPLICA: 'replica_date'
+}
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def phase(name, interval):
+    """
+    Постоянное смещение хоста внутри интервала, вычисляется по имени хоста
+    """
+    if interval <= 0:
+        return 0
+    return (zlib.crc32(name.encode('utf-8')) & 0xffffffff) % interval
+
+
+def next_run(name, interval, now=None, jitter=0):
+    """
+    Ближайшее время запуска после now с учётом смещения хоста и случайного разброса.
+    Хосты с одинаковым интервалом равномерно распределяются по интервалу и не запускаются одновременно.
+    """
+    if now is None:
+        now = datetime.datetime.now()
+    if interval <= 0:
+        return now
+    seconds = (now - EPOCH).total_seconds()
+    start = seconds - (seconds - phase(name, interval)) % interval
+    if start <= seconds:
+        start += interval
+    if jitter:
+        start += random.uniform(0, jitter)
+    return EPOCH + datetime.timedelta(seconds=start)
+
+
+def retry_date(name, interval, failures, now=None, base=300, threshold=5, probe=21600, jitter=0):
+    """
+    Время следующего запуска с учётом количества неудачных попыток подряд.
+    Повторы с экспоненциальной задержкой, после threshold неудач подряд - редкие пробные запуски раз в probe секунд.
+    """
+    if now is None:
+        now = datetime.datetime.now()
+    if not failures:
+        return next_run(name, interval, now, jitter)
+    if threshold and failures >= threshold:
+        delay = probe
+    else:
+        delay = base * 2 ** (failures - 1)
+        if delay >= interval:
+            return next_run(name, interval, now, jitter)
+    if jitter:
+        delay += random.uniform(0, jitter)
+    return now + datetime.timedelta(seconds=delay)
+
+
+def load_report(entries, horizon, slots):
+    """
+    Ожидаемая нагрузка по интервалам времени
+    :param entries: [(смещение, интервал, длительность)] в секундах
+    :return: [(начало интервала, количество запусков, ожидаемое количество заданий)]
+    """
+    size = float(horizon) / slots
+    starts = [0] * slots
+    busy = [0.0] * slots
+    for offset, interval, duration in entries:
+        if interval <= 0:
+            continue
+        begin = offset
+        while begin < horizon:
+            starts[int(begin // size)] += 1
+            # Длительность задания распределяется по интервалам, которые оно занимает,
+            # выходящая за горизонт часть переносится в начало(расписание повторяется)
+            start, end = begin, begin + duration
+            while end > start:
+                index = int(start // size)
+                while end > index * size and index < slots:
+                    busy[index] += (min(end, (index + 1) * size) - max(start, index * size)) / size
+                    index += 1
+                start, end = 0, end - horizon
+            begin += interval
+    return [(int(i * size), starts[i], busy[i]) for i in range(slots)]
+
+
+def run_job(func, host, kwargs):
+    """
+    Выполнение задания в процессе пула
+    :return: (результат задания, текст исключения или None)
+    """
+    # Исключение в задании не должно оставлять хост в статусе выполнения,
+    # текст исключения записывается в журнал основным процессом
+    try:
+        return func(host, **kwargs), None
+    except Exception:
+        return False, traceback.format_exc()
+
+
+class Scheduler:
+    def __init__(self, pool, jobs, threads, logging, resources=None, tunnels=None, failed=None, prober=None,
+                 metrics=None, cluster=None):
+        self.pool = pool            # type: multiprocessing.Pool
+        self.jobs = jobs            # type: dict
+        self.threads = threads
+        self.logging = logging      # type: rb_log.Log
+        self.resources = resources  # type: resources.Resources
+        self.tunnels = tunnels      # type: proxy.Forwarder
+        self.failed = failed        # callback(host, job, now) -> время повторного запуска
+        self.prober = prober        # type: prober.Prober
+        self.metrics = metrics      # type: metrics.Metrics
+        self.cluster = cluster      # type: cluster.Cluster
+        self.held = {}
+
+        self.queue = []             # (due, seq, host_id, job)
+        self.ready = []             # задания, время которых наступило
+        self.hosts = {}
+        self.running = {}
+        self.results = {}           # host_id: AsyncResult
+        self.done = []
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.counter = itertools.count()
+
+    def add(self, due, host, job):
+        self.hosts[host.id] = host
+        heapq.heappush(self.queue, (due, next(self.counter), host.id, job))
+
+    def reschedule(self, due, host, job):
+        """
+        Перенос ожидающего задания хоста на новое время
+        """
+        self.queue = [item for item in self.queue if item[2] != host.id or item[3] != job]
+        heapq.heapify(self.queue)
+        self.ready = [item for item in self.ready if item[2] != host.id or item[3] != job]
+        self.add(due, host, job)
+
+    def _callback(self, host_id, job):
+        def callback(value):
+            with self.lock:
+                self.done.append((host_id, job) + tuple(value))
+            self.event.set()
+        return callback
+
+    def _error_callback(self, host_id, job):
+        """
+        Ошибка вне run_job(результат не передан из процесса пула): хост не должен остаться в статусе выполнения
+        """
+        def callback(err):
+            with self.lock:
+                self.done.append((host_id, job, False, repr(err)))
+            self.event.set()
+        return callback
+
+    def _lost(self):
+        """
+        python 2: apply_async без error_callback, ошибка определяется по результату задания
+        """
+        for host_id, result in list(self.results.items()):
+            if result is not None and result.ready() and not result.successful():
+                try:
+                    result.get(0)
+                except Exception as err:
+                    self._error_callback(host_id, self.running.get(host_id))(err)
+                self.results[host_id] = None
+
+    def completed(self):
+        if not ERROR_CALLBACK:
+            self._lost()
+        with self.lock:
+            done, self.done = self.done, []
+        for host_id, job, result, trace in done:
+            self.running.pop(host_id, None)
+            self.results.pop(host_id, None)
+            if self.resources:
+                self.resources.release(self.held.pop(host_id, []))
+            if self.cluster:
+                self.cluster.release(host_id)
+            if trace:
+                self.logging.error('Scheduler - {job} {host} ошибка выполнения:\n{trace}'.format(
+                    job=job, host=self.hosts[host_id].name, trace=trace))
+            self.logging.debug('Scheduler - {job} {host} завершено.'.format(job=job, host=self.hosts[host_id].name))
+        return [(host_id, job, result) for host_id, job, result, trace in done]
+
+    def address(self, host):
+        """
+        Адрес проверки доступности: прокси сервер или сам хост
+        """
+        if host.proxy and self.tunnels and host.proxy in self.tunnels.proxies:
+            proxy = self.tunnels.proxies[host.proxy]
+            return proxy.ip, int(proxy.port)
+        return host.ip, int(host.port)
+
+    def retry(self, host, job, now, count=True):
+        """
+        :param count: учитывать неудачу в счётчике хоста
+        """
+        if self.failed:
+            return self.failed(host, job, now, count)
+        return now + datetime.timedelta(seconds=300)
+
+    def probe(self, now):
+        """
+        Проверка доступности всех готовых к запуску хостов одновременно,
+        недоступные хосты не занимают процессы пула и откладываются
+        """
+        items = [item for item in self.ready if item[3] not in LOCAL and item[2] not in self.running]
+        if not items:
+            return
+        start = time.time()
+        alive = self.prober.probe([self.address(self.hosts[item[2]]) for item in items])
+        if self.metrics:
+            self.metrics.observe(rb_metrics.PROBE, time.time() - start)
+        # Одна проверка - не больше одной неудачи хоста, сколько бы его заданий ни было готово
+        counted = set()
+        warned = set()
+        for item in items:
+            host = self.hosts[item[2]]
+            if alive.get(self.address(host)):
+                continue
+            if item[2] not in warned:
+                self.logging.warning('Хост {host.name}({address[0]}, {address[1]}) - не доступен!'.format(
+                    host=host, address=self.address(host)))
+                warned.add(item[2])
+            self.ready.remove(item)
+            # Несколько узлов: неудача записывается в общую базу только узлом, получившим аренду хоста,
+            # иначе задание откладывается только на этом узле
+            if self.cluster:
+                claimed, host, retry = self.cluster.claim(host, item[3], now)
+                self.hosts[item[2]] = host
+                if not claimed:
+                    if retry is not None:
+                        self.add(retry, host, item[3])
+                    continue
+            self.add(self.retry(host, item[3], now, item[2] not in counted), host, item[3])
+            counted.add(item[2])
+            if self.cluster:
+                self.cluster.release(item[2])
+
+    def _release(self, host_id):
+        """
+        Освобождение ресурсов и аренды задания, которое не было запущено
+        """
+        if self.resources:
+            self.resources.release(self.held.pop(host_id, []))
+        if self.cluster:
+            self.cluster.release(host_id)
+
+    def dispatch(self, now=None):
+        if now is None:
+            now = datetime.datetime.now()
+
+        while self.queue and self.queue[0][0] <= now:
+            self.ready.append(heapq.heappop(self.queue))
+        self.ready.sort()
+        if self.prober and len(self.running) < self.threads:
+            self.probe(now)
+
+        pending = set((item[2], item[3]) for item in self.ready)
+        for item in list(self.ready):
+            if len(self.running) >= self.threads:
+                break
+            due, seq, host_id, job = item
+            if host_id in self.running:
+                continue
+            # Резервное копирование выполняется после обнаружения модулей хоста
+            if job in (BACKUP, VERIFY) and (host_id, DISCOVERING) in pending:
+                continue
+            # Задание запускается только при наличии свободных слотов всех его ресурсов
+            if self.resources:
+                keys = self.resources.keys(self.hosts[host_id], job)
+                if not self.resources.acquire(keys):
+                    continue
+                self.held[host_id] = keys
+
+            self.ready.remove(item)
+            pending.discard((host_id, job))
+            host = self.hosts[host_id]
+
+            # Несколько узлов: задание запускает узел, получивший аренду хоста
+            if self.cluster:
+                claimed, host, retry = self.cluster.claim(host, job, now)
+                if not claimed:
+                    if self.resources:
+                        self.resources.release(self.held.pop(host_id, []))
+                    if retry is not None:
+                        self.add(retry, host, job)
+                    continue
+                self.hosts[host_id] = host
+
+            kwargs = {}
+            # Доступность проверена probe(), процесс пула не проверяет её повторно
+            if self.prober and job not in LOCAL:
+                kwargs['probed'] = True
+            if self.tunnels and host.proxy and job not in LOCAL:
+                # Перенаправление открывает процесс перенаправления, планировщик его не ожидает
+                try:
+                    address, tunnel_time = self.tunnels.forward(host.proxy, host.ip, host.port)
+                except rb_error.RBError as err:
+                    self.logging.error('Хост {host.name} - ошибка формирования тунеля: {err}'.format(host=host,
+                                                                                                    err=err))
+                    self._release(host_id)
+                    self.add(self.retry(host, job, now), host, job)
+                    continue
+                if address is None:
+                    self._release(host_id)
+                    self.add(now + datetime.timedelta(seconds=TUNNEL_WAIT), host, job)
+                    continue
+                kwargs['address'] = address
+                kwargs['tunnel_time'] = tunnel_time
+                if self.metrics and tunnel_time:
+                    self.metrics.observe(rb_metrics.TUNNEL, tunnel_time)
+
+            self.running[host_id] = job
+            self.logging.debug('Scheduler - {job} {host} запуск.'.format(job=job, host=host.name))
+            options = {'callback': self._callback(host_id, job)}
+            if ERROR_CALLBACK:
+                options['error_callback'] = self._error_callback(host_id, job)
+            self.results[host_id] = self.pool.apply_async(run_job, (self.jobs[job], host, kwargs), **options)
+
+    def wait(self, max_wait):
+        timeout = max_wait
+        if self.queue and len(self.running) < self.threads:
+            delta = self.queue[0][0] - datetime.datetime.now()
+            timeout = min(max_wait, max(delta.total_seconds(), 0))
+        self.event.wait(timeout)
+        self.event.clear()
+
+    def __len__(self):
+        return len(self.queue) + len(self.ready)
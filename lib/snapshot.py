@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    Filename : snapshot
+    Date: 17.10.2026 14:00
+    Project: pyRsyncBackup
+    AUTHOR : Sergey Utkin
+
+    Copyright 2019 Sergey Utkin utkins01@gmail.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import datetime
+import json
+import os
+import shutil
+
+DELTA = 'delta'
+SNAPSHOT = 'snapshot'
+
+TIMESTAMP = '%Y-%m-%d-%H-%M-%S'
+CURRENT = 'current'
+LATEST = 'latest'
+PARTIAL = '.partial'
+# Изменения, полученные незавершёнными запусками в каталог .partial
+ITEMS = '.partial.items'
+
+
+def parse(name):
+    """
+    Дата резервной копии по имени каталога или None
+    """
+    try:
+        return datetime.datetime.strptime(name, TIMESTAMP)
+    except ValueError:
+        return None
+
+
+def listing(destination):
+    """
+    Каталоги резервных копий модуля, отсортированные по дате
+    :return: [(дата, имя каталога)]
+    """
+    if not os.path.isdir(destination):
+        return []
+    result = []
+    for name in os.listdir(destination):
+        date = parse(name)
+        if date and os.path.isdir(os.path.join(destination, name)) and not os.path.islink(
+                os.path.join(destination, name)):
+            result.append((date, name))
+    return sorted(result)
+
+
+def latest(destination):
+    """
+    Путь последнего завершённого снимка или None
+    """
+    link = os.path.join(destination, LATEST)
+    if os.path.isdir(link):
+        return os.path.realpath(link)
+    return None
+
+
+def prepare(destination, timestamp):
+    """
+    Каталог для нового снимка. Незавершённый снимок предыдущего запуска переиспользуется,
+    чтобы не передавать повторно уже скопированные файлы.
+    """
+    work = os.path.join(destination, timestamp + PARTIAL)
+    partial = sorted(name for name in os.listdir(destination) if name.endswith(PARTIAL))
+    if partial:
+        os.rename(os.path.join(destination, partial.pop()), work)
+    elif os.path.exists(os.path.join(destination, ITEMS)):
+        os.remove(os.path.join(destination, ITEMS))
+    for name in partial:
+        shutil.rmtree(os.path.join(destination, name), ignore_errors=True)
+    return work
+
+
+def save_items(destination, items, received):
+    """
+    Сохранение изменений незавершённого запуска: следующий запуск не получит эти файлы повторно
+    :param items: [(тип изменения, путь)] для каталога файлов
+    :param received: [путь] полученных файлов для дедупликации
+    """
+    with open(os.path.join(destination, ITEMS), 'a') as f:
+        for kind, path in items:
+            f.write(json.dumps(['item', kind, path]) + '\n')
+        for path in received:
+            f.write(json.dumps(['received', path]) + '\n')
+
+
+def pop_items(destination):
+    """
+    Изменения незавершённых запусков, переиспользованных текущим снимком. Файл изменений удаляется.
+    :return: ([(тип изменения, путь)], [путь])
+    """
+    items = []
+    received = []
+    path = os.path.join(destination, ITEMS)
+    if not os.path.exists(path):
+        return items, received
+    with open(path) as f:
+        for text in f:
+            try:
+                record = json.loads(text)
+            except ValueError:
+                # Строка, недописанная при аварийном завершении
+                continue
+            if record[0] == 'item':
+                items.append((record[1], record[2]))
+            else:
+                received.append(record[1])
+    os.remove(path)
+    return items, received
+
+
+def commit(destination, timestamp):
+    """
+    Завершение снимка и атомарное переключение ссылки latest
+    """
+    os.rename(os.path.join(destination, timestamp + PARTIAL), os.path.join(destination, timestamp))
+    link = os.path.join(destination, LATEST + '.tmp')
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(timestamp, link)
+    os.rename(link, os.path.join(destination, LATEST))
@@ -21,17 +21,17 @@
    See the License for the specific language governing permissions and
    limitations under the License.
 """
+import collections
 import datetime
 import sys
 import os
-import time
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 import signal
 import socket
+import time
 from contextlib import closing
-from sqlalchemy import create_engine
-import subprocess
-from contextlib import contextmanager
+from functools import partial
 
 # App Lib
 run_dir_name, run_file_name = os.path.split(os.path.abspath(__file__))
@@ -41,6 +41,20 @@ import log as rb_log
 import database as rb_db
 import error as rb_error
 import proxy as rb_proxy
+import scheduler as rb_scheduler
+import discovery as rb_discovery
+import runner as rb_runner
+import snapshot as rb_snapshot
+import retention as rb_retention
+import prober as rb_prober
+import resources as rb_resources
+import history as rb_history
+import metrics as rb_metrics
+import adaptive as rb_adaptive
+import cluster as rb_cluster
+import dedup as rb_dedup
+import catalog as rb_catalog
+import replica as rb_replica
 
 __author__ = 'Sergey Utkin'
 __email__ = 'utkins01@gmail.com'
@@ -52,6 +66,9 @@ __program__ = 'pyRsyncBackup'
 
 global appLogging
 
+worker_engine = None
+discovery_engine = None
+
 dev_null = open(os.devnull, 'w')
 
 
@@ -76,31 +93,304 @@ def alive_host(ip, port):
             return False
 
 
-def discovering(host):
+def retry_date(host, interval, failures, now=None):
+    return rb_scheduler.retry_date(host.name, rb_conf.calc_size(interval), failures, now,
+                                   appConfiguration.RetryInterval,
+                                   appConfiguration.CircuitThreshold,
+                                   appConfiguration.CircuitProbe,
+                                   appConfiguration.Jitter)
+
+
+def job_failed(host, job, now, count=True):
+    """
+    Хост недоступен, не удалось сформировать туннель или задание завершилось ошибкой:
+    увеличение счётчика неудач и время повторной попытки
+    :param count: False - неудача уже учтена для другого задания хоста в той же проверке
+    """
+    # Локальные задания не зависят от доступности хоста и не меняют счётчик неудач
+    if job in rb_scheduler.LOCAL:
+        return retry_date(host, host.backup_interval, 1, now)
+    if count or not host.failures:
+        host.failures = (host.failures or 0) + 1
+    interval = host.discovering_interval if job == rb_scheduler.DISCOVERING else host.backup_interval
+    due = retry_date(host, interval, host.failures, now)
+    with rb_db.edit(engine) as dbe:
+        dbe.query(rb_db.Host).filter(rb_db.Host.id == host.id).update(
+            {rb_db.Host.failures: host.failures, rb_scheduler.DATE_COLUMNS[job]: due})
+    if count and host.failures == appConfiguration.CircuitThreshold:
+        appLogging.warning('Хост {host.name} - {count} неудачных попыток подряд, '
+                           'следующие попытки раз в {probe} секунд'.format(host=host, count=host.failures,
+                                                                          probe=appConfiguration.CircuitProbe))
+    return due
+
+
+def init_worker():
+    # Одно подключение к базе данных на всё время жизни процесса пула
+    global worker_engine, discovery_engine
+    worker_engine = rb_db.get_engine(appConfiguration, appConfiguration.worker_connections())
+    discovery_engine = rb_discovery.Discovery(appLogging, appConfiguration.JobTimeout)
+
+
+def discovering(host, address=None, tunnel_time=None, probed=False):
+    """
+    Обнаружение модулей хоста
+    :param probed: доступность проверена планировщиком перед запуском
+    """
     if interrupted:
         appLogging.debug('Discovering - {host.name} skip.'.format(host=host))
         return False
 
-    discover_engine = create_engine(
-        'postgresql://{c.DbLogin}:{c.DbPassword}@{c.DbHost}:{c.DbPort}/{c.DbBase}'.format(c=appConfiguration))
-
     appLogging.debug('Discovering - {host.name}.'.format(host=host))
-    tunnel = None
 
-    with rb_db.edit(discover_engine) as dbe:
-        discovering_interval = rb_conf.calc_size(host.discovering_interval)
+    if not os.path.isdir(os.path.join(appConfiguration.log['dir'], 'hosts')):
+        os.makedirs(os.path.join(appConfiguration.log['dir'], 'hosts'))
+    host_logging = rb_log.Log(host.name,
+                              os.path.join(appConfiguration.log['dir'], 'hosts', host.name + '.log'),
+                              appConfiguration.log['level'],
+                              appConfiguration.log['count'],
+                              appConfiguration.log['size']
+                              )
+
+    # Порт хоста, перенаправленный через прокси сервер основным процессом
+    if address:
+        host.ip, host.port = address
+
+    phases = rb_metrics.Phases()
+    # Повторная проверка только без планировщика: для хоста за прокси проверен адрес прокси,
+    # недоступный хост приводит к ошибке rsync, а не к ожиданию соединения в процессе пула
+    if probed or alive_host(host.ip, host.port):
+        host_logging.debug('Хост: {host.name}({host.ip}, {host.port}) - доступен.'.format(host=host))
+        with phases(rb_metrics.DB), rb_db.select(worker_engine) as db:
+            rows = rb_db.discovery_modules(db, host.id)
+        modules = [module for module, active_module in rows]
+        active = [module.name for module, active_module in rows if active_module is not None]
+
+        with phases(rb_metrics.DISCOVERY):
+            found = discovery_engine.modules(host, modules, host_logging)
+        if found is not None:
+            for module in found:
+                host_logging.debug('Хост: {host.name} - найден модуль {module.name}'.format(module=module, host=host))
+    else:
+        found = None
+        active = []
+        host_logging.warning('Хост: {host} - не доступен!'.format(host=host.name))
+
+    # Результат обнаружения и срок следующего запуска записываются одной транзакцией,
+    # при ошибке - повтор с увеличивающейся задержкой
+    failures = 0 if found is not None else (host.failures or 0) + 1
+    with phases(rb_metrics.DB), rb_db.edit(worker_engine) as dbe:
+        if found is not None:
+            rb_db.save_discovery(dbe, host.id, [module.name for module in found], active)
         dbe.query(rb_db.Host).filter(rb_db.Host.id == host.id).update(
-            {rb_db.Host.discovering_date: datetime.datetime.now() + datetime.timedelta(seconds=discovering_interval)}
+            {rb_db.Host.discovering_date: retry_date(host, host.discovering_interval, failures),
+             rb_db.Host.failures: failures}
         )
 
-    rsync_dry_run = '/usr/bin/rsync --dry-run --timeout=15 '
+    del host_logging
+    return phases.result(found is not None)
+
+
+def backup_module(host, host_logging, bwlimit, tunnel_time, verify, item):
+    """
+    Резервное копирование одного модуля хоста
+    :type host: rb_db.Host
+    :type host_logging: rb_log.Log
+    :type bwlimit: int
+    :param verify: сравнение файлов по контрольным суммам(-c) с учётом расхождений
+    :param item: (rb_db.ActiveModules, rb_db.Module)
+    :return: (active_module, длительность копирования или None, успешность или None если не запускалось,
+              запись истории или None, полученные файлы для дедупликации [(путь, файл current)])
+    """
+    active_module, module = item
+    if interrupted:
+        return active_module, None, None, None, []
+
+    # Обычный запуск сравнивает файлы по размеру и времени изменения, полное чтение файлов - только при проверке
+    command = '/usr/bin/rsync -alk --timeout=15 --info=progress2,stats2 --ignore-errors --delete '
+    if verify or appConfiguration.Dedup or appConfiguration.Catalog:
+        command += '--itemize-changes '
+    if verify:
+        command += '-c '
+        if appConfiguration.VerifyIdle and os.path.isfile('/usr/bin/ionice'):
+            command = '/usr/bin/ionice -c3 /usr/bin/nice -n19 ' + command
     if host.user:
-        source = 'rsync://{host.user}@{host.ip}:{host.port}{module.path}'
+        source = 'rsync://{host.user}@{host.ip}:{host.port}{module.path} '
     else:
-        source = 'rsync://{host.ip}:{host.port}{module.path}'
+        source = 'rsync://{host.ip}:{host.port}{module.path} '
+    destination = '{host.backup_directory}/{host.name}/{module.name}'
+
     if host.password:
-        rsync_dry_run += '--password-file {host.password} '
-    rsync_dry_run += source
+        command += '--password-file {host.password} '
+    if bwlimit:
+        command += '--bwlimit={0} '.format(bwlimit)
+
+    timestamp = datetime.datetime.now().strftime(rb_snapshot.TIMESTAMP)
+    module_dir = destination.format(host=host, module=module)
+    backup_dir = os.path.join(module_dir, timestamp)
+    if not os.path.isdir(module_dir):
+        os.makedirs(module_dir)
+
+    # Пакет для реплики записывается относительно состояния основной копии до запуска
+    batch = None
+    base = None
+    if module.replica:
+        batch = rb_replica.batch_path(appConfiguration.ReplicaBatchDir, host, module, timestamp)
+        if not os.path.isdir(appConfiguration.ReplicaBatchDir):
+            os.makedirs(appConfiguration.ReplicaBatchDir)
+
+    if module.mode == rb_snapshot.SNAPSHOT:
+        # Незавершённый снимок не воспроизводится пакетом, реплика выравнивается полной синхронизацией
+        if rb_replica.partial(module_dir):
+            batch = None
+        # Полный снимок, неизменённые файлы - жёсткие ссылки на предыдущий снимок
+        target = rb_snapshot.prepare(module_dir, timestamp)
+        final = backup_dir
+        if rb_snapshot.latest(module_dir):
+            command += '--link-dest={0} '.format(rb_snapshot.latest(module_dir))
+            base = os.path.basename(rb_snapshot.latest(module_dir))
+    else:
+        target = os.path.join(module_dir, rb_snapshot.CURRENT)
+        final = target
+        command += '--backup --backup-dir {backup_dir} '
+        if os.path.isdir(target):
+            base = rb_snapshot.CURRENT
+    if batch:
+        command += '--write-batch={0} '.format(batch)
+
+    rsync = command
+    if module.exclude:
+        if os.path.isfile(module.exclude):
+            rsync += "--exclude-from {0} ".format(module.exclude)
+        else:
+            for exclude in str(module.exclude).split(','):
+                rsync += "--exclude {0} ".format(exclude.strip())
+    if module.include:
+        if os.path.isfile(module.include):
+            rsync += "--include-from {0} ".format(module.include)
+        else:
+            for include in str(module.include).split(','):
+                rsync += "--include {0} ".format(include.strip())
+
+    rsync += source + target
+    host_logging.debug('run command: {rsync}'.format(rsync=rsync.format(host=host,
+                                                                        module=module,
+                                                                        backup_dir=backup_dir)))
+
+    def progress(current):
+        host_logging.debug('Хост: {host.name} модуль {module.name} - передано {c[bytes]} байт, {c[percent]}%, '
+                           '{c[rate]}, файлов {c[files]}'.format(host=host, module=module, c=current))
+
+    drift = []
+    changed = []
+    items = []
+
+    def line(text):
+        item = rb_runner.itemize(text)
+        if item is None:
+            return
+        if appConfiguration.Dedup and rb_runner.received(item):
+            changed.append((os.path.join(final, item[3]), module.mode != rb_snapshot.SNAPSHOT))
+        if appConfiguration.Catalog and rb_catalog.change(item):
+            items.append((rb_catalog.change(item), item[3]))
+        if verify and rb_runner.drift(item):
+            drift.append(item[3])
+            host_logging.warning('Хост: {host.name} модуль {module.name} - расхождение контрольной суммы: '
+                                 '{path}'.format(host=host, module=module, path=item[3]))
+
+    start = datetime.datetime.now()
+    run = rb_runner.Runner(rsync.format(host=host, module=module, backup_dir=backup_dir).split(),
+                           timeout=appConfiguration.JobTimeout,
+                           progress=progress,
+                           line=line if verify or appConfiguration.Dedup or appConfiguration.Catalog else None)
+    try:
+        run.run()
+    except OSError:
+        host_logging.error('Хост: {host.name} - error subprocess.Popen'.format(host=host))
+        rb_replica.remove_batch(batch)
+        return active_module, None, False, None, []
+
+    if run.timed_out:
+        host_logging.warning(
+            'Хост: {host.name} - превышено время резервного копирования {module.name}\n'
+            '{res}'.format(module=module, host=host, res=run.output()))
+    elif run.returncode == 0:
+        if module.mode == rb_snapshot.SNAPSHOT:
+            rb_snapshot.commit(module_dir, timestamp)
+        host_logging.info(
+            'Хост: {host.name} - успешное резервное копирование {module.name}, '
+            'передано {bytes} байт, файлов {files}'.format(module=module, host=host,
+                                                          bytes=run.stats.get('transferred_size', 0),
+                                                          files=run.stats.get('files_transferred', 0)))
+    else:
+        host_logging.warning(
+            'Хост: {host.name} - Ошибка резервного копирования {module.name}\n'
+            '{res}'.format(module=module, host=host, res=run.output()))
+
+    if module.mode != rb_snapshot.SNAPSHOT and os.path.isdir(backup_dir):
+        if len(os.listdir(backup_dir)) == 0:
+            os.rmdir(backup_dir)
+
+    success = run.returncode == 0 and not run.timed_out
+    # Незавершённый снимок будет переименован следующим запуском, его изменения записываются вместе с ним
+    if module.mode == rb_snapshot.SNAPSHOT and not success:
+        rb_snapshot.save_items(module_dir, items, [os.path.relpath(path, final) for path, mutable in changed])
+        changed = []
+        items = []
+    elif module.mode == rb_snapshot.SNAPSHOT:
+        previous, received = rb_snapshot.pop_items(module_dir)
+        kinds = collections.OrderedDict()
+        for kind, path in previous + items:
+            # Файл, впервые полученный незавершённым запуском, в снимке остаётся новым или отсутствует
+            if kinds.get(path) == rb_catalog.NEW and kind == rb_catalog.DELETED:
+                del kinds[path]
+            elif not (kinds.get(path) == rb_catalog.NEW and kind == rb_catalog.CHANGED):
+                kinds[path] = kind
+        items = [(kind, path) for path, kind in kinds.items()]
+        paths = set(path for path, mutable in changed)
+        changed = [(os.path.join(final, path), False) for path in received
+                   if os.path.join(final, path) not in paths] + changed
+    if module.replica:
+        if not success:
+            rb_replica.remove_batch(batch)
+        rb_replica.enqueue(worker_engine, host.id, module.name, timestamp, batch if success else None, base)
+    if items:
+        count = rb_catalog.record(worker_engine, host.id, module, timestamp, final, items, start)
+        host_logging.debug('Хост: {host.name} модуль {module.name} - записей каталога файлов {count}'.format(
+            host=host, module=module, count=count))
+    return (active_module, run.duration, success,
+            rb_history.record(active_module, module, start, run, tunnel_time, len(drift) if verify else None),
+            changed)
+
+
+def module_job(host, host_logging, bwlimit, tunnel_time, verify, item):
+    """
+    Ошибка одного модуля не отменяет результаты остальных модулей хоста: исключение становится
+    неудачным результатом этого модуля
+    """
+    try:
+        return backup_module(host, host_logging, bwlimit, tunnel_time, verify, item)
+    except Exception:
+        host_logging.error('Хост: {host.name} - ошибка резервного копирования {module.name}'.format(
+            host=host, module=item[1]), exc_info=True)
+        return item[0], None, False, None, []
+
+
+def verify_interval(module):
+    return rb_conf.calc_size(module.verify) if module.verify else appConfiguration.VerifyInterval
+
+
+def backup(host, address=None, tunnel_time=None, verify=False, probed=False):
+    """
+    Резервное копирование модулей хоста
+    :param verify: проверочный запуск с контрольными суммами для модулей, срок проверки которых наступил
+    :param probed: доступность проверена планировщиком перед запуском
+    """
+    if interrupted:
+        appLogging.debug('Backup - {host.name} skip.'.format(host=host))
+        return False
+
+    appLogging.debug('{job} - {host.name}.'.format(host=host, job='Verify' if verify else 'Backup'))
+
     if not os.path.isdir(os.path.join(appConfiguration.log['dir'], 'hosts')):
         os.makedirs(os.path.join(appConfiguration.log['dir'], 'hosts'))
     host_logging = rb_log.Log(host.name,
@@ -110,94 +400,135 @@ def discovering(host):
                               appConfiguration.log['size']
                               )
 
-    if host.proxy:
-        with rb_db.select(discover_engine) as db:
-            proxy = db.query(rb_db.Proxy).filter(rb_db.Proxy.id == host.proxy).one()
-
-        if not alive_host(proxy.ip, proxy.port):
-            appLogging.warning('Хост {host.name} прокси сервер {proxy.ip} - не доступен!!!'
-                               .format(proxy=proxy, host=host))
-            return False
-
-        tunnel = rb_proxy.Proxy(proxy, host, host_logging)
-        try:
-            tunnel.start()
-        except rb_error.RBError as err:
-            appLogging.error(err)
-            del host_logging
-            return False
-
-        if tunnel.is_active():
-            host.ip, host.port = tunnel.get_port_forward_info()
-        else:
-            appLogging.error('Хост {host.name} прокси сервер {proxy.ip} - Ошибка формирования тунеля!!!'
-                             .format(proxy=proxy, host=host))
-            del host_logging
-            return False
+    if address:
+        host.ip, host.port = address
 
-    if alive_host(host.ip, host.port):
+    phases = rb_metrics.Phases()
+    success = False
+    received = 0
+    column = rb_db.Host.verify_date if verify else rb_db.Host.backup_date
+    if probed or alive_host(host.ip, host.port):
         host_logging.debug('Хост: {host.name}({host.ip}, {host.port}) - доступен.'.format(host=host))
-        with rb_db.edit(discover_engine) as dbe:
-            dbe.query(rb_db.ActiveModules).filter(rb_db.ActiveModules.host == host.id).delete()
-        with rb_db.select(discover_engine) as db:
-            modules = db.query(rb_db.Module).all()
-        for module in modules:
-            if interrupted:
-                break
-
-            host_logging.debug('run discovering: {cmd}'.format(cmd=rsync_dry_run.format(host=host, module=module)))
-            try:
-                run = subprocess.Popen(rsync_dry_run.format(host=host, module=module).split(),
-                                       stdout=subprocess.PIPE,
-                                       stderr=subprocess.PIPE)
-                run.wait()
-                res = run.communicate()
-            except:
-                host_logging.error('Хост: {host.name} - error subprocess.Popen')
-                break
-            if run.returncode == 0:
-                host_logging.debug('Хост: {host.name} - найден модуль {module.name}'.format(module=module, host=host))
-                with rb_db.edit(discover_engine) as dbe:
-                    dbe.add(rb_db.ActiveModules(host=host.id, module=module.name))
+        with phases(rb_metrics.DB), rb_db.select(worker_engine) as db:
+            active_modules = rb_db.host_modules(db, host.id)
+
+        now = datetime.datetime.now()
+        if verify:
+            # Проверяются модули, срок проверки которых наступил
+            active_modules = [item for item in active_modules if verify_interval(item[1])]
+            waiting = [m for m, module in active_modules if m.verify_date and m.verify_date > now]
+        else:
+            # Модули, отложенные после ошибок, ждут своего срока
+            waiting = [m for m, module in active_modules if m.next_date and m.next_date > now]
+        active_modules = [item for item in active_modules if item[0] not in waiting]
+
+        # Первыми запускаются модули с наибольшим ожидаемым временем копирования
+        active_modules.sort(key=lambda item: item[0].duration if item[0].duration is not None else float('inf'),
+                            reverse=True)
+        concurrency = min(int(host.module_concurrency or appConfiguration.ModuleConcurrency), len(active_modules))
+        # Каждому потоку модуля нужно соединение с базой данных, одно остаётся за заданием хоста
+        concurrency = min(concurrency, appConfiguration.worker_connections() - 1)
+
+        bwlimit = appConfiguration.bwlimit(max(concurrency, 1), verify)
+        if concurrency > 1:
+            module_pool = ThreadPool(concurrency)
+            results = module_pool.map(partial(module_job, host, host_logging, bwlimit, tunnel_time, verify),
+                                      active_modules)
+            module_pool.close()
+            module_pool.join()
+        else:
+            results = [module_job(host, host_logging, bwlimit, tunnel_time, verify, m) for m in active_modules]
+
+        modules = dict((item[0].module, item[1]) for item in active_modules)
+        due = [m.verify_date if verify else m.next_date for m in waiting]
+        # Один срок со случайным разбросом на запуск хоста: успешные модули снова копируются вместе
+        baseline = retry_date(host, host.backup_interval, 0)
+        updates = []
+        runs = []
+        queue = []
+        for active_module, duration, success, run, changed in results:
+            queue += [{'host': host.id, 'path': path, 'mutable': mutable} for path, mutable in changed]
+            if run:
+                runs.append(run)
+                phases.add(rb_metrics.RSYNC, run['duration'])
+                received += run.get('bytes_received', 0)
+            if success is None:
+                due.append(now)
+                continue
+            values = {'host': active_module.host, 'module': active_module.module}
+            if verify:
+                # Проверка не влияет на расписание и статистику обычных запусков
+                if success:
+                    values['verify_date'] = now + datetime.timedelta(
+                        seconds=verify_interval(modules[active_module.module]))
+                else:
+                    values['verify_date'] = retry_date(host, host.backup_interval, 1)
+                due.append(values['verify_date'])
+                updates.append(values)
+                continue
+            if duration is not None:
+                if active_module.duration is not None:
+                    duration = 0.7 * active_module.duration + 0.3 * duration
+                values['duration'] = duration
+            values['failures'] = 0 if success else (active_module.failures or 0) + 1
+            if values['failures'] == appConfiguration.CircuitThreshold:
+                host_logging.warning('Хост: {host.name} - модуль {module} {count} неудачных попыток подряд'.format(
+                    host=host, module=active_module.module, count=values['failures']))
+            if success:
+                values['next_date'] = baseline
             else:
-                host_logging.debug('Хост: {host.name} - нет модуля {module.name}'.format(module=module, host=host))
-
-            del res, run
+                values['next_date'] = retry_date(host, host.backup_interval, values['failures'])
+            due.append(values['next_date'])
+            updates.append(values)
+
+        # Состояние модулей и срок следующего запуска хоста записываются одной транзакцией
+        with phases(rb_metrics.DB), rb_db.edit(worker_engine) as dbe:
+            dbe.bulk_update_mappings(rb_db.ActiveModules, updates)
+            dbe.bulk_insert_mappings(rb_db.BackupRun, runs)
+            dbe.bulk_insert_mappings(rb_db.DedupQueue, queue)
+
+            # Следующий запуск хоста - ближайший срок среди его модулей
+            if verify:
+                if not due:
+                    due.append(now + datetime.timedelta(seconds=appConfiguration.VerifyInterval or 86400))
+            else:
+                due.append(baseline)
+            dbe.query(rb_db.Host).filter(rb_db.Host.id == host.id).update(
+                {column: min(due), rb_db.Host.failures: 0})
+        success = all(run['success'] for run in runs) and all(item[2] is not False for item in results)
     else:
         host_logging.warning('Хост: {host} - не доступен!'.format(host=host.name))
+        failures = (host.failures or 0) + 1
+        with phases(rb_metrics.DB), rb_db.edit(worker_engine) as dbe:
+            dbe.query(rb_db.Host).filter(rb_db.Host.id == host.id).update(
+                {column: retry_date(host, host.backup_interval, failures),
+                 rb_db.Host.failures: failures}
+            )
+
+    del host_logging
+    return phases.result(success, received)
 
-    if isinstance(tunnel, rb_proxy.Proxy):
-        tunnel.stop()
 
-    del host_logging, tunnel
+def verify(host, address=None, tunnel_time=None, probed=False):
+    return backup(host, address, tunnel_time, True, probed)
 
 
-def backup(host):
+def retention(host):
     if interrupted:
-        appLogging.debug('Backup - {host.name} skip.'.format(host=host))
+        appLogging.debug('Retention - {host.name} skip.'.format(host=host))
         return False
 
-    backup_engine = create_engine(
-        'postgresql://{c.DbLogin}:{c.DbPassword}@{c.DbHost}:{c.DbPort}/{c.DbBase}'.format(c=appConfiguration))
-
-    tunnel = None
-    appLogging.debug('Backup - {host.name}.'.format(host=host))
+    appLogging.debug('Retention - {host.name}.'.format(host=host))
 
-    with rb_db.edit(backup_engine) as dbe:
-        backup_interval = rb_conf.calc_size(host.backup_interval)
+    with rb_db.edit(worker_engine) as dbe:
         dbe.query(rb_db.Host).filter(rb_db.Host.id == host.id).update(
-            {rb_db.Host.backup_date: datetime.datetime.now() + datetime.timedelta(seconds=backup_interval)}
+            {rb_db.Host.retention_date: rb_scheduler.next_run(host.name, appConfiguration.RetentionInterval,
+                                                              jitter=appConfiguration.Jitter)}
         )
 
-    command = '/usr/bin/rsync -aclk --timeout=15 --ignore-errors --delete --backup --backup-dir {backup_dir} '
-    if host.user:
-        source = 'rsync://{host.user}@{host.ip}:{host.port}{module.path} '
-    else:
-        source = 'rsync://{host.ip}:{host.port}{module.path} '
-    destination = '{host.backup_directory}/{host.name}/{module.name}'
-
-    if host.password:
-        command += '--password-file {host.password} '
+    host_dir = os.path.join(host.backup_directory, host.name)
+    if not os.path.isdir(host_dir):
+        return True
 
     if not os.path.isdir(os.path.join(appConfiguration.log['dir'], 'hosts')):
         os.makedirs(os.path.join(appConfiguration.log['dir'], 'hosts'))
@@ -208,106 +539,179 @@ def backup(host):
                               appConfiguration.log['size']
                               )
 
-    if host.proxy:
-        with rb_db.select(backup_engine) as db:
-            proxy = db.query(rb_db.Proxy).filter(rb_db.Proxy.id == host.proxy).one()
-
-        if not alive_host(proxy.ip, proxy.port):
-            appLogging.warning('Хост {host.name} прокси сервер {proxy.ip} - не доступен!!!'
-                               .format(proxy=proxy, host=host))
-            del host_logging
-            return False
+    with rb_db.select(worker_engine) as db:
+        modules = dict((module.name, module) for module in db.query(rb_db.Module).all())
+
+    delete = []
+    catalog = []
+    for name in sorted(os.listdir(host_dir)):
+        module_dir = os.path.join(host_dir, name)
+        if interrupted or not os.path.isdir(module_dir):
+            continue
+        module = modules.get(name)
+        policy = rb_retention.Policy().load(appConfiguration.Retention)
+        mode = rb_snapshot.DELTA
+        if module:
+            policy.load(module.retention)
+            mode = module.mode
+        to_delete, to_merge = policy.plan(module_dir, mode)
+        for source, target in to_merge:
+            host_logging.debug('Retention: {source} -> {target}'.format(source=source, target=target))
+            rb_retention.merge(source, target)
+        delete += to_delete
+        catalog.append((name, [(os.path.basename(source), os.path.basename(target)) for source, target in to_merge],
+                        [os.path.basename(path) for path in to_delete]))
+
+    # Удаление выполняется параллельно с ограничением одновременных операций ввода-вывода
+    reclaimed = 0
+    if delete:
+        for path in delete:
+            host_logging.debug('Retention: удаление {path}'.format(path=path))
+        io_pool = ThreadPool(max(1, min(appConfiguration.RetentionThreads, len(delete))))
+        reclaimed = sum(io_pool.map(rb_retention.remove, delete))
+        io_pool.close()
+        io_pool.join()
+        host_logging.info('Хост: {host.name} - удалено резервных копий {count}, освобождено {size} байт'.format(
+            host=host, count=len(delete), size=reclaimed))
+
+    # Записи каталога файлов следуют за каталогами резервных копий
+    catalog = [item for item in catalog if item[1] or item[2]]
+    if catalog:
+        with rb_db.edit(worker_engine) as dbe:
+            for name, merges, names in catalog:
+                for source, target in merges:
+                    rb_catalog.merge(dbe, host.id, name, source, target)
+                rb_catalog.forget(dbe, host.id, name, names)
+
+    del host_logging
+    return True
+
+
+def dedup(host):
+    """
+    Дедупликация файлов, полученных резервным копированием хоста
+    """
+    if interrupted:
+        appLogging.debug('Dedup - {host.name} skip.'.format(host=host))
+        return False
 
-        tunnel = rb_proxy.Proxy(proxy, host, host_logging)
-        try:
-            tunnel.start()
-        except rb_error.RBError as err:
-            appLogging.error(err)
-            del host_logging
-            return False
+    appLogging.debug('Dedup - {host.name}.'.format(host=host))
 
-        if tunnel.is_active():
-            host.ip, host.port = tunnel.get_port_forward_info()
-        else:
-            appLogging.error('Хост {host.name} прокси сервер {proxy.ip} - Ошибка формирования тунеля!!!'
-                             .format(proxy=proxy, host=host))
-            del host_logging
-            return False
+    with rb_db.edit(worker_engine) as dbe:
+        dbe.query(rb_db.Host).filter(rb_db.Host.id == host.id).update(
+            {rb_db.Host.dedup_date: rb_scheduler.next_run(host.name, appConfiguration.DedupInterval,
+                                                          jitter=appConfiguration.Jitter)}
+        )
 
-    if alive_host(host.ip, host.port):
-        host_logging.debug('Хост: {host.name}({host.ip}, {host.port}) - доступен.'.format(host=host))
-        with rb_db.select(backup_engine) as db:
-            active_modules = db.query(rb_db.ActiveModules).filter(rb_db.ActiveModules.host == host.id).all()
+    if not os.path.isdir(os.path.join(appConfiguration.log['dir'], 'hosts')):
+        os.makedirs(os.path.join(appConfiguration.log['dir'], 'hosts'))
+    host_logging = rb_log.Log(host.name,
+                              os.path.join(appConfiguration.log['dir'], 'hosts', host.name + '.log'),
+                              appConfiguration.log['level'],
+                              appConfiguration.log['count'],
+                              appConfiguration.log['size']
+                              )
 
-        for active_module in active_modules:
-            if interrupted:
+    phases = rb_metrics.Phases()
+    start = datetime.datetime.now()
+    dedup_engine = rb_dedup.Dedup(worker_engine, host_logging, appConfiguration.DedupMinSize,
+                                  appConfiguration.DedupReflink)
+    total = {'files': 0, 'linked': 0, 'reflinked': 0, 'saved': 0}
+    with phases(rb_metrics.DEDUP):
+        while not interrupted:
+            result = dedup_engine.step(host.id)
+            if result is None:
                 break
-            with rb_db.select(backup_engine) as db:
-                module = db.query(rb_db.Module).filter(rb_db.Module.name == active_module.module).one()
-            backup_dir = destination.format(host=host, module=module) + datetime.datetime.now().strftime(
-                '/%Y-%m-%d-%H-%M-%S')
-            if not os.path.isdir(destination.format(host=host, module=module)):
-                os.makedirs(destination.format(host=host, module=module))
-            rsync = command
-            if module.exclude:
-                if os.path.isfile(module.exclude):
-                    rsync += "--exclude-from {0} ".format(module.exclude)
-                else:
-                    for exclude in str(module.exclude).split(','):
-                        rsync += "--exclude {0} ".format(exclude.strip())
-            if module.include:
-                if os.path.isfile(module.include):
-                    rsync += "--include-from {0} ".format(module.include)
-                else:
-                    for include in str(module.include).split(','):
-                        rsync += "--include {0} ".format(include.strip())
+            for key in total:
+                total[key] += result[key]
 
-            rsync += source + destination + '/current'
-            host_logging.debug('run command: {rsync}'.format(rsync=rsync.format(host=host,
-                                                                                module=module,
-                                                                                backup_dir=backup_dir)))
-            try:
-                run = subprocess.Popen(rsync.format(host=host, module=module, backup_dir=backup_dir).split(),
-                                       stdout=subprocess.PIPE,
-                                       stderr=subprocess.PIPE)
-                run.wait()
-                res = run.communicate()
-            except:
-                host_logging.error('Хост: {host.name} - error subprocess.Popen')
-                break
-            if run.returncode == 0:
-                host_logging.info(
-                    'Хост: {host.name} - успешное резервное копирование {module.name}'.format(module=module, host=host))
-            else:
-                host_logging.warning(
-                    'Хост: {host.name} - Ошибка резервного копирования {module.name}\n'
-                    '{res}'.format(module=module, host=host, res=res))
+    if total['files']:
+        host_logging.info('Хост: {host.name} - дедупликация: файлов {files}, жёстких ссылок {linked}, '
+                          'reflink {reflinked}, освобождено {saved} байт'.format(host=host, **total))
+        values = dict(total, host=host.id, start_date=start,
+                      duration=(datetime.datetime.now() - start).total_seconds())
+        with phases(rb_metrics.DB), rb_db.edit(worker_engine) as dbe:
+            dbe.bulk_insert_mappings(rb_db.DedupRun, [values])
 
-            del res, run
-            if os.path.isdir(backup_dir):
-                if len(os.listdir(backup_dir)) == 0:
-                    os.rmdir(backup_dir)
+    del host_logging
+    return phases.result(True, saved=total['saved'])
 
-    else:
-        host_logging.warning('Хост: {host} - не доступен!'.format(host=host.name))
 
-    if isinstance(tunnel, rb_proxy.Proxy):
-        tunnel.stop()
+def replica(host):
+    """
+    Применение пакетов rsync к репликам модулей хоста
+    """
+    if interrupted:
+        appLogging.debug('Replica - {host.name} skip.'.format(host=host))
+        return False
 
-    del host_logging, tunnel
+    appLogging.debug('Replica - {host.name}.'.format(host=host))
 
+    if not os.path.isdir(os.path.join(appConfiguration.log['dir'], 'hosts')):
+        os.makedirs(os.path.join(appConfiguration.log['dir'], 'hosts'))
+    host_logging = rb_log.Log(host.name,
+                              os.path.join(appConfiguration.log['dir'], 'hosts', host.name + '.log'),
+                              appConfiguration.log['level'],
+                              appConfiguration.log['count'],
+                              appConfiguration.log['size']
+                              )
 
-@contextmanager
-def pool_context(*args, **kwargs):
-    pool = Pool(*args, **kwargs)
-    yield pool
-    pool.terminate()
+    phases = rb_metrics.Phases()
+    with phases(rb_metrics.DB), rb_db.select(worker_engine) as db:
+        queue = rb_replica.pending(db, host.id)
+        modules = dict((module.name, module) for module in db.query(rb_db.Module).filter(
+            rb_db.Module.name.in_(list(queue))).all()) if queue else {}
+
+    replica_engine = rb_replica.Replica(worker_engine, host_logging, appConfiguration.JobTimeout)
+    success = True
+    for name, entries in sorted(queue.items()):
+        if interrupted:
+            break
+        module = modules.get(name)
+        # Реплика отключена в конфигурации модуля
+        if module is None or module.disabled or not module.replica:
+            with rb_db.edit(worker_engine) as dbe:
+                dbe.query(rb_db.ReplicaQueue).filter(rb_db.ReplicaQueue.id.in_([e.id for e in entries])).delete(
+                    synchronize_session=False)
+            for entry in entries:
+                rb_replica.remove_batch(entry.batch)
+            continue
+
+        with phases(rb_metrics.REPLICA):
+            result, applied, full = replica_engine.module(host, module, entries)
+        success = success and result
+        if not result:
+            host_logging.warning('Хост: {host.name} - ошибка репликации {module.name} в {module.replica}'.format(
+                host=host, module=module))
+            continue
+        host_logging.info('Хост: {host.name} - реплика {module.name}: применено пакетов {applied}{full}'.format(
+            host=host, module=module, applied=applied, full=', полная синхронизация' if full else ''))
+
+        # Политика хранения основной копии применяется к реплике
+        directory = os.path.join(module.replica, host.name, module.name)
+        policy = rb_retention.Policy().load(appConfiguration.Retention).load(module.retention)
+        to_delete, to_merge = policy.plan(directory, module.mode)
+        for source, target in to_merge:
+            rb_retention.merge(source, target)
+        for path in to_delete:
+            rb_retention.remove(path)
+
+    due = rb_scheduler.next_run(host.name, appConfiguration.ReplicaInterval, jitter=appConfiguration.Jitter)
+    if not success:
+        due = retry_date(host, appConfiguration.ReplicaInterval, 1)
+    with phases(rb_metrics.DB), rb_db.edit(worker_engine) as dbe:
+        dbe.query(rb_db.Host).filter(rb_db.Host.id == host.id).update({rb_db.Host.replica_date: due})
+
+    del host_logging
+    return phases.result(success)
 
 
 signal.signal(signal.SIGTERM, handle_sig_term)
 signal.signal(signal.SIGINT, handle_sig_term)
 
-appConfiguration = rb_conf.AppConfiguration('/etc/pyRsyncBackup/pyRsyncBackup.conf')
+# Путь к конфигурационному файлу можно передать первым аргументом
+appConfiguration = rb_conf.AppConfiguration(sys.argv[1] if len(sys.argv) > 1 else
+                                            '/etc/pyRsyncBackup/pyRsyncBackup.conf')
 if not os.path.isdir(appConfiguration.log['dir']):
     try:
         os.mkdir(appConfiguration.log['dir'])
@@ -325,6 +729,13 @@ appLogging = rb_log.Log(__program__,
 appLogging.info('Запуск приложения {program} {version}. PID:{pid}'
                 .format(program=__program__, version=__version__, pid=os.getpid()))
 
+pool_size = appConfiguration.limit_pool()
+if pool_size:
+    appLogging.warning('Количество процессов пула уменьшено с {old} до {new}: не больше (DataBase Connections - 2) '
+                       '/ (ModuleConcurrency + 1)({connections}, {concurrency})'.format(
+                           old=pool_size, new=appConfiguration.pool_size(), connections=appConfiguration.DbConnections,
+                           concurrency=appConfiguration.ModuleConcurrency))
+
 if not os.path.isfile('/usr/bin/rsync'):
     appLogging.critical('Отсутствует исполняемый файл /usr/bin/rsync!!!')
     app_exit(1)
@@ -333,51 +744,164 @@ if not appConfiguration.HostList:
     appLogging.critical('Отсутствует значение директории с конфигурацией узлов!!!')
     app_exit(1)
 
-engine = create_engine(
-    'postgresql://{c.DbLogin}:{c.DbPassword}@{c.DbHost}:{c.DbPort}/{c.DbBase}'.format(c=appConfiguration))
+# Второе соединение основного процесса удерживает блокировку синхронизации конфигурации
+engine = rb_db.get_engine(appConfiguration, 2)
 
 try:
-    rb_db.check_database(engine)
+    rb_db.check_database(engine, appConfiguration.DbConnectAttempts)
 except rb_error.RBError as error:
     appLogging.critical(error)
     app_exit(1)
 
-for config_file in os.listdir(appConfiguration.HostList):
-    if os.path.split(config_file)[-1].split('.')[-1] in ["cfg", "conf"]:
-        try:
-            appLogging.debug('Инициализация конфигурации: {file}'.format(
-                file=os.path.join(appConfiguration.HostList, config_file)))
-            rb_db.import_host(engine, os.path.join(appConfiguration.HostList, config_file))
-        except rb_error.RBError as e:
-            appLogging.warning(e)
-
-appConfiguration.load_modules(engine)
+# Узлы кластера синхронизируют конфигурацию с базой данных по очереди
+with rb_db.exclusive(engine):
+    host_names = []
+    config_failed = False
+    for config_file in os.listdir(appConfiguration.HostList):
+        if os.path.split(config_file)[-1].split('.')[-1] in ["cfg", "conf"]:
+            try:
+                appLogging.debug('Инициализация конфигурации: {file}'.format(
+                    file=os.path.join(appConfiguration.HostList, config_file)))
+                host_names += rb_db.import_host(engine, os.path.join(appConfiguration.HostList, config_file))
+            except rb_error.RBError as e:
+                config_failed = True
+                appLogging.warning(e)
+
+    # При ошибке чтения конфигурации хосты не отключаются, чтобы не потерять их расписание
+    if not config_failed:
+        disabled = rb_db.disable_hosts(engine, host_names)
+        if disabled:
+            appLogging.info('Отключено хостов, отсутствующих в конфигурации: {count}'.format(count=disabled))
+
+    appConfiguration.load_modules(engine)
+pruned = rb_db.prune_history(engine, appConfiguration.HistoryKeep)
+if pruned:
+    appLogging.info('Удалено записей истории запусков: {count}'.format(count=pruned))
 appLogging.debug('Инициализация завершена.')
 
 interrupted = False
-discovering_list = []
-backup_list = []
-
-while True:
-    time.sleep(1)
-    del discovering_list
-    with rb_db.select(engine) as dbs:
-        discovering_list = dbs.query(rb_db.Host).filter(rb_db.Host.discovering_date < datetime.datetime.now()).all()
-
-    if len(discovering_list) > 0:
-        with pool_context(processes=appConfiguration.Threads) as p:
-            p.map(discovering, discovering_list)
-
-    time.sleep(1)
-
-    del backup_list
-
-    with rb_db.select(engine) as dbs:
-        backup_list = dbs.query(rb_db.Host).filter(rb_db.Host.backup_date < datetime.datetime.now()).all()
-
-    if len(backup_list) > 0:
-        with pool_context(processes=appConfiguration.Threads) as p:
-            p.map(backup, backup_list)
-
-    if interrupted:
-        app_exit(0)
+tunnels = rb_proxy.Forwarder(appLogging, appConfiguration.TunnelKeepAlive, appConfiguration.TunnelIdleTimeout)
+with rb_db.select(engine) as dbs:
+    tunnels.load(dbs.query(rb_db.Proxy).all())
+
+# Соединения основного процесса не должны наследоваться процессами пула
+engine.dispose()
+# Процесс перенаправления портов не наследует соединения с базой данных
+tunnels.start()
+workers = Pool(processes=appConfiguration.pool_size(), initializer=init_worker)
+
+# HTTP сервер метрик запускается после создания пула, процессы пула не наследуют его сокет
+metrics = rb_metrics.Metrics()
+with rb_db.select(engine) as dbs:
+    for name, date in rb_history.last_success(dbs):
+        metrics.success(name, rb_scheduler.BACKUP, time.mktime(date.timetuple()))
+if appConfiguration.MetricsListen:
+    try:
+        metrics.serve(*appConfiguration.MetricsListen)
+    except socket.error as e:
+        appLogging.error('Ошибка запуска HTTP сервера метрик {listen}: {e}'.format(
+            listen=appConfiguration.MetricsListen, e=e))
+metrics_written = 0
+
+cluster = None
+if appConfiguration.Cluster:
+    cluster = rb_cluster.Cluster(engine, appConfiguration.ClusterNode, appConfiguration.ClusterLeaseTTL,
+                                 appConfiguration.ClusterHeartbeat, appLogging, appConfiguration.ClusterAffinity,
+                                 appConfiguration.ClusterAffinityDelay)
+    released = cluster.release_all()
+    appLogging.info('Cluster: узел {node}, снято аренд предыдущего запуска: {count}'.format(
+        node=appConfiguration.ClusterNode, count=released))
+
+scheduler = rb_scheduler.Scheduler(workers,
+                                   {rb_scheduler.DISCOVERING: discovering,
+                                    rb_scheduler.BACKUP: backup,
+                                    rb_scheduler.RETENTION: retention,
+                                    rb_scheduler.VERIFY: verify,
+                                    rb_scheduler.DEDUP: dedup,
+                                    rb_scheduler.REPLICA: replica},
+                                   appConfiguration.Threads,
+                                   appLogging,
+                                   rb_resources.Resources(appConfiguration.Resources),
+                                   tunnels,
+                                   job_failed,
+                                   rb_prober.Prober(appConfiguration.ProbeTimeout, appConfiguration.ProbeTTL),
+                                   metrics,
+                                   cluster)
+
+controller = None
+if appConfiguration.Adaptive:
+    scheduler.threads = min(max(appConfiguration.Threads, appConfiguration.AdaptiveMin), appConfiguration.pool_size())
+    controller = rb_adaptive.Controller(appConfiguration.AdaptiveMin, appConfiguration.pool_size(),
+                                        appConfiguration.AdaptiveInterval, appLogging,
+                                        appConfiguration.AdaptiveIOWait, appConfiguration.AdaptiveLatency)
+
+now = datetime.datetime.now()
+report = []
+with rb_db.select(engine) as dbs:
+    replicas = dbs.query(rb_db.Module).filter(rb_db.Module.replica != None, rb_db.Module.disabled == False).count()
+    for h in dbs.query(rb_db.Host).filter(rb_db.Host.disabled == False).all():
+        # Просроченные задания распределяются по интервалу резервного копирования хоста
+        spread = rb_scheduler.next_run(h.name, rb_conf.calc_size(h.backup_interval), now, appConfiguration.Jitter)
+        scheduler.add(spread if h.discovering_date < now else h.discovering_date,
+                      h, rb_scheduler.DISCOVERING)
+        scheduler.add(spread if h.backup_date < now else h.backup_date,
+                      h, rb_scheduler.BACKUP)
+        # Колонки, добавленные обновлением схемы, в существующих записях не заполнены
+        scheduler.add(h.retention_date or now, h, rb_scheduler.RETENTION)
+        scheduler.add(h.verify_date if h.verify_date and h.verify_date >= now else rb_scheduler.next_run(
+            h.name, appConfiguration.VerifyInterval or 86400, now, appConfiguration.Jitter), h, rb_scheduler.VERIFY)
+        if appConfiguration.Dedup:
+            scheduler.add(h.dedup_date or now, h, rb_scheduler.DEDUP)
+        if replicas:
+            scheduler.add(h.replica_date or now, h, rb_scheduler.REPLICA)
+
+        duration = sum(m.duration or 0 for m in dbs.query(rb_db.ActiveModules).filter(
+            rb_db.ActiveModules.host == h.id).all())
+        duration /= max(int(h.module_concurrency or appConfiguration.ModuleConcurrency), 1)
+        report.append((rb_scheduler.phase(h.name, rb_conf.calc_size(h.backup_interval)),
+                       rb_conf.calc_size(h.backup_interval), duration))
+
+if report:
+    horizon = max(interval for offset, interval, duration in report)
+    for offset, starts, busy in rb_scheduler.load_report(report, horizon, appConfiguration.ReportSlots):
+        appLogging.info('Планирование: +{offset}s - запусков {starts}, ожидаемая нагрузка {busy:.1f}'.format(
+            offset=offset, starts=starts, busy=busy))
+
+while not interrupted:
+    # Перепланирование только завершившихся хостов
+    for host_id, job, result in scheduler.completed():
+        with rb_db.select(engine) as dbs:
+            h = dbs.query(rb_db.Host).filter(rb_db.Host.id == host_id).one()
+        due = rb_scheduler.due_date(h, job)
+        # Задание, завершившееся исключением, могло не записать срок следующего запуска
+        if result is False and not interrupted and (due is None or due <= datetime.datetime.now()):
+            due = job_failed(h, job, datetime.datetime.now())
+        scheduler.add(due, h, job)
+        # Пакеты, записанные резервным копированием, применяются к репликам без ожидания интервала
+        if replicas and job in (rb_scheduler.BACKUP, rb_scheduler.VERIFY):
+            scheduler.reschedule(h.replica_date or datetime.datetime.now(), h, rb_scheduler.REPLICA)
+        metrics.job(h.name, job, result)
+        if controller:
+            controller.job(result)
+
+    if controller:
+        controller.tick(scheduler)
+    scheduler.dispatch()
+    if cluster:
+        cluster.heartbeat(scheduler.running)
+    metrics.scheduler(scheduler, datetime.datetime.now())
+    if appConfiguration.MetricsTextFile and time.time() - metrics_written >= appConfiguration.MetricsInterval:
+        metrics_written = time.time()
+        try:
+            metrics.write(appConfiguration.MetricsTextFile)
+        except (IOError, OSError) as e:
+            appLogging.error('Ошибка записи файла метрик: {e}'.format(e=e))
+    tunnels.poll()
+    scheduler.wait(5)
+
+workers.close()
+workers.join()
+tunnels.stop()
+if cluster:
+    cluster.release_all()
+app_exit(0)
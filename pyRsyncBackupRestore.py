@@ -0,0 +1,221 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""
+    Filename : pyRsyncBackupRestore
+    Date: 18.10.2026 00:00
+    Project: pyRsyncBackup
+    AUTHOR : Sergey Utkin
+
+    Copyright 2019 Sergey Utkin utkins01@gmail.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import argparse
+import datetime
+import os
+import sys
+import tempfile
+import time
+from functools import partial
+from multiprocessing.pool import ThreadPool
+
+# App Lib
+run_dir_name, run_file_name = os.path.split(os.path.abspath(__file__))
+sys.path.append(os.path.join(run_dir_name, 'lib'))
+import config as rb_conf
+import database as rb_db
+import error as rb_error
+import log as rb_log
+import proxy as rb_proxy
+import runner as rb_runner
+import snapshot as rb_snapshot
+import catalog as rb_catalog
+import restore as rb_restore
+
+__program__ = 'pyRsyncBackupRestore'
+
+FORMATS = [rb_snapshot.TIMESTAMP, '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d']
+
+
+def parse_date(value):
+    for fmt in FORMATS:
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError('формат даты: {0}'.format(', '.join(FORMATS)))
+
+
+def size(value):
+    for unit in ['B', 'K', 'M', 'G']:
+        if abs(value) < 1024:
+            return '{0:.1f}{1}'.format(value, unit)
+        value /= 1024.0
+    return '{0:.1f}T'.format(value)
+
+
+def rsync(command, root, paths, destination, progress=None):
+    """
+    Один запуск rsync по списку путей
+    :return: rb_runner.Runner
+    """
+    with tempfile.NamedTemporaryFile(prefix='pyRsyncBackupRestore.') as f:
+        rb_restore.write_list(f, paths)
+        run = rb_runner.Runner(command + ['--from0', '--files-from={0}'.format(f.name), root + '/', destination],
+                               progress=progress)
+        try:
+            run.run()
+        except OSError as e:
+            print('Ошибка запуска rsync: {0}'.format(e))
+            run.returncode = -1
+    if run.returncode != 0:
+        print('rsync {root} -> {destination}: код завершения {code}\n{output}'.format(
+            root=root, destination=destination, code=run.returncode, output=run.output()))
+    return run
+
+
+def stream(command, destination, item):
+    """
+    Поток восстановления: каталоги-источники обрабатываются последовательно
+    :param item: (номер потока, {каталог: [пути]})
+    :return: (получено байт, успешность)
+    """
+    number, bucket = item
+
+    def progress(current):
+        print('Поток {number}: {bytes}, {percent}%, {rate}'.format(number=number, bytes=size(current['bytes']),
+                                                                  percent=current['percent'], rate=current['rate']))
+
+    transferred = 0
+    success = True
+    for root, paths in sorted(bucket.items()):
+        run = rsync(command, root, paths, destination, progress)
+        transferred += run.stats.get('transferred_size', 0)
+        success = success and run.returncode == 0
+    return transferred, success
+
+
+parser = argparse.ArgumentParser(prog=__program__,
+                                 description='Восстановление модуля хоста на дату из резервных копий')
+parser.add_argument('-c', '--config', default='/etc/pyRsyncBackup/pyRsyncBackup.conf',
+                    help='основной конфигурационный файл')
+parser.add_argument('host', help='имя хоста')
+parser.add_argument('module', help='модуль')
+parser.add_argument('--date', type=parse_date, help='состояние на дату, по умолчанию последняя копия')
+parser.add_argument('--path', help='восстанавливаемый путь относительно каталога резервной копии')
+target = parser.add_mutually_exclusive_group(required=True)
+target.add_argument('--target', help='локальный каталог восстановления')
+target.add_argument('--push', action='store_true', help='восстановление на rsync демон хоста')
+parser.add_argument('--streams', type=int, default=4, help='количество параллельных потоков rsync')
+parser.add_argument('--bwlimit', type=rb_conf.calc_size, default=0,
+                    help='общая полоса пропускания, байт в секунду, суффиксы K, M, G')
+parser.add_argument('--dry-run', action='store_true', help='только план восстановления')
+arguments = parser.parse_args()
+
+appConfiguration = rb_conf.AppConfiguration(arguments.config)
+engine = rb_db.get_engine(appConfiguration, 1)
+with rb_db.select(engine) as db:
+    host = db.query(rb_db.Host).filter(rb_db.Host.name == arguments.host).first()
+    module = db.query(rb_db.Module).filter(rb_db.Module.name == arguments.module).first()
+    proxy = db.query(rb_db.Proxy).filter(rb_db.Proxy.id == host.proxy).first() if host and host.proxy else None
+if host is None or module is None:
+    print('Хост {0} или модуль {1} не найден'.format(arguments.host, arguments.module))
+    sys.exit(1)
+
+module_dir = os.path.join(host.backup_directory, host.name, module.name)
+try:
+    roots = rb_restore.sources(module_dir, module.mode, arguments.date)
+except rb_error.RBError as e:
+    print(e)
+    sys.exit(1)
+
+# Файлы, созданные после даты, находятся в current и исключаются по каталогу файлов
+absent = set()
+if arguments.date and module.mode != rb_snapshot.SNAPSHOT:
+    with rb_db.select(engine) as db:
+        first = rb_catalog.since(db, host.id, module.name)
+        if first is None:
+            print('Каталог файлов модуля {0} пуст, состояние на дату в режиме delta восстановить нельзя: '
+                  'файлы, созданные после даты, не будут исключены'.format(module.name))
+            sys.exit(1)
+        if arguments.date < first:
+            print('Предупреждение: каталог файлов модуля {0} ведётся с {1}, файлы, созданные до этой даты '
+                  'и после {2}, не будут исключены'.format(module.name, first, arguments.date))
+        absent = rb_catalog.absent(db, host.id, module, arguments.date)
+files, dirs = rb_restore.plan(roots, arguments.path, absent)
+buckets = rb_restore.split(files, arguments.streams)
+
+print('Источники: {0}'.format(', '.join(os.path.basename(root) for root in roots)))
+print('Файлов {files}, каталогов {dirs}, объём {size}, потоков {streams}'.format(
+    files=len(files), dirs=len(dirs), size=size(sum(item[1] for item in files.values())), streams=len(buckets)))
+if arguments.dry_run:
+    for number, bucket in enumerate(buckets):
+        print('Поток {0}: файлов {1}, {2}'.format(number, sum(len(paths) for paths in bucket.values()),
+                                                 size(sum(files[rel][1] for paths in bucket.values()
+                                                          for rel in paths))))
+    sys.exit(0)
+
+command = ['/usr/bin/rsync', '-a', '--info=progress2,stats2']
+if arguments.bwlimit:
+    command.append('--bwlimit={0}'.format(max(1, arguments.bwlimit // 1024 // max(len(buckets), 1))))
+
+tunnels = None
+if arguments.target:
+    destination = arguments.target.rstrip('/') + '/'
+    if not os.path.isdir(destination):
+        os.makedirs(destination)
+else:
+    address = (host.ip, host.port)
+    if proxy:
+        tunnels = rb_proxy.TunnelManager(rb_log.Log(__program__,
+                                                    os.path.join(appConfiguration.log['dir'], 'restore.log'),
+                                                    appConfiguration.log['level'],
+                                                    appConfiguration.log['count'],
+                                                    appConfiguration.log['size']))
+        tunnels.load([proxy])
+        try:
+            address = tunnels.forward(proxy.id, host.ip, host.port)
+        except rb_error.RBError as e:
+            print(e)
+            sys.exit(1)
+    # Без завершающего '/' копия содержит каталог модуля вместе с его именем
+    path = module.path if module.path.endswith('/') else os.path.dirname(module.path).rstrip('/') + '/'
+    destination = 'rsync://{user}{address[0]}:{address[1]}{path}'.format(
+        user=host.user + '@' if host.user else '', address=address, path=path)
+    if host.password:
+        command.append('--password-file={0}'.format(host.password))
+
+start = time.time()
+pool = ThreadPool(max(1, len(buckets)))
+results = pool.map(partial(stream, command, destination), list(enumerate(buckets)))
+pool.close()
+pool.join()
+
+# Каталоги последними: атрибуты и время изменения каталогов после записи файлов
+roots_dirs = {}
+for rel, root in dirs.items():
+    roots_dirs.setdefault(root, []).append(rel)
+for root, paths in sorted(roots_dirs.items()):
+    results.append((0, rsync(command, root, paths, destination).returncode == 0))
+
+if tunnels:
+    tunnels.stop()
+
+transferred = sum(item[0] for item in results)
+duration = time.time() - start
+success = all(item[1] for item in results)
+print('{status}: передано {size} за {duration:.0f}s, {rate}/s'.format(
+    status='Восстановление завершено' if success else 'Восстановление завершено с ошибками',
+    size=size(transferred), duration=duration, rate=size(transferred / duration if duration else 0)))
+sys.exit(0 if success else 1)
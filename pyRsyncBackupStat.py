@@ -0,0 +1,153 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""
+    Filename : pyRsyncBackupStat
+    Date: 17.10.2026 17:00
+    Project: pyRsyncBackup
+    AUTHOR : Sergey Utkin
+
+    Copyright 2019 Sergey Utkin utkins01@gmail.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import argparse
+import os
+import sys
+
+# App Lib
+run_dir_name, run_file_name = os.path.split(os.path.abspath(__file__))
+sys.path.append(os.path.join(run_dir_name, 'lib'))
+import config as rb_conf
+import database as rb_db
+import history as rb_history
+import catalog as rb_catalog
+
+__program__ = 'pyRsyncBackupStat'
+
+
+def size(value):
+    for unit in ['B', 'K', 'M', 'G']:
+        if abs(value) < 1024:
+            return '{0:.1f}{1}'.format(value, unit)
+        value /= 1024.0
+    return '{0:.1f}T'.format(value)
+
+
+def host_id(engine, name):
+    if name is None:
+        return None
+    with rb_db.select(engine) as db:
+        host = db.query(rb_db.Host).filter(rb_db.Host.name == name).first()
+    if host is None:
+        print('Хост {0} не найден'.format(name))
+        sys.exit(1)
+    return host.id
+
+
+def throughput(engine, args):
+    with rb_db.select(engine) as db:
+        rows = rb_history.throughput(db, args.since, host_id(engine, args.host), args.module)
+    print('{0:<12}{1:>8}{2:>12}{3:>12}{4:>12}'.format('date', 'runs', 'received', 'duration', 'rate/s'))
+    for date, count, received, duration, rate in rows:
+        print('{0:<12}{1:>8}{2:>12}{3:>12.0f}{4:>12}'.format(str(date), count, size(received), duration, size(rate)))
+
+
+def slowest(engine, args):
+    with rb_db.select(engine) as db:
+        rows = rb_history.slowest(db, args.since, args.limit, host_id(engine, args.host))
+    print('{0:<30}{1:<30}{2:>8}{3:>12}{4:>12}'.format('host', 'module', 'runs', 'avg', 'max'))
+    for name, module, count, average, maximum in rows:
+        print('{0:<30}{1:<30}{2:>8}{3:>12.0f}{4:>12.0f}'.format(name, module, count, average or 0, maximum or 0))
+
+
+def failures(engine, args):
+    with rb_db.select(engine) as db:
+        rows = rb_history.failures(db, args.since, host_id(engine, args.host))
+    print('{0:<30}{1:<30}{2:>8}{3:>8}{4:>8}'.format('host', 'module', 'runs', 'failed', 'rate'))
+    for name, module, count, failed, rate in rows:
+        print('{0:<30}{1:<30}{2:>8}{3:>8}{4:>7.0%}'.format(name, module, count, failed, rate))
+
+
+def drift(engine, args):
+    with rb_db.select(engine) as db:
+        rows = rb_history.drift(db, args.since, host_id(engine, args.host))
+    print('{0:<30}{1:<30}{2:>8}{3:>8}{4:>22}'.format('host', 'module', 'runs', 'drift', 'last'))
+    for name, module, count, files, last in rows:
+        print('{0:<30}{1:<30}{2:>8}{3:>8}{4:>22}'.format(name, module, count, files or 0, str(last)[:19]))
+
+
+def dedup(engine, args):
+    with rb_db.select(engine) as db:
+        rows = rb_history.dedup(db, args.since, host_id(engine, args.host))
+    print('{0:<30}{1:>8}{2:>10}{3:>10}{4:>10}{5:>12}'.format('host', 'runs', 'files', 'linked', 'reflink', 'saved'))
+    total = 0
+    for name, count, files, linked, reflinked, saved in rows:
+        total += saved or 0
+        print('{0:<30}{1:>8}{2:>10}{3:>10}{4:>10}{5:>12}'.format(name, count, files or 0, linked or 0,
+                                                                 reflinked or 0, size(saved or 0)))
+    print('{0:<68}{1:>12}'.format('total', size(total)))
+
+
+def find(engine, args):
+    with rb_db.select(engine) as db:
+        rows = rb_catalog.find(db, args.path, host_id(engine, args.host), args.module, args.prefix, args.limit)
+    print('{0:<20}{1:<20}{2:<22}{3:<9}{4:>10}  {5:<21}{6}'.format('host', 'module', 'snapshot', 'change', 'size',
+                                                                   'mtime', 'path'))
+    for name, module, path, snapshot, change, length, mtime, date in rows:
+        print('{0:<20}{1:<20}{2:<22}{3:<9}{4:>10}  {5:<21}{6}'.format(
+            name, module, snapshot, change, size(length) if length is not None else '-',
+            str(mtime)[:19] if mtime else '-', path))
+
+
+parser = argparse.ArgumentParser(prog=__program__, description='История запусков резервного копирования')
+parser.add_argument('-c', '--config', default='/etc/pyRsyncBackup/pyRsyncBackup.conf',
+                    help='основной конфигурационный файл')
+commands = parser.add_subparsers(dest='command')
+
+command = commands.add_parser('throughput', help='скорость передачи по дням')
+command.add_argument('--module')
+command.set_defaults(func=throughput)
+
+command = commands.add_parser('slowest', help='модули с наибольшим средним временем копирования')
+command.add_argument('--limit', type=int, default=10)
+command.set_defaults(func=slowest)
+
+command = commands.add_parser('failures', help='доля неудачных запусков по модулям')
+command.set_defaults(func=failures)
+
+command = commands.add_parser('drift', help='расхождения, найденные проверкой контрольными суммами')
+command.set_defaults(func=drift)
+
+command = commands.add_parser('dedup', help='место, освобождённое дедупликацией')
+command.set_defaults(func=dedup)
+
+for command in commands.choices.values():
+    command.add_argument('--since', type=rb_conf.calc_size, default='7d', help='период, суффиксы m, h, d')
+    command.add_argument('--host', help='имя хоста')
+
+command = commands.add_parser('find', help='версии файла по каталогу файлов')
+command.add_argument('path', help='путь файла на хосте')
+command.add_argument('--prefix', action='store_true', help='все файлы, путь которых начинается с path')
+command.add_argument('--module')
+command.add_argument('--host', help='имя хоста')
+command.add_argument('--limit', type=int, default=100)
+command.set_defaults(func=find)
+
+arguments = parser.parse_args()
+if not getattr(arguments, 'func', None):
+    parser.print_help()
+    sys.exit(1)
+
+appConfiguration = rb_conf.AppConfiguration(arguments.config)
+arguments.func(rb_db.get_engine(appConfiguration, 1), arguments)